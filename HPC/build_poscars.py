@@ -1,56 +1,321 @@
-import ase.io
 import os
+import argparse
 import numpy as np
-from ase.constraints import FixAtoms, FixedLine, FixedPlane
+from chain import plan_chain, write_seeds
+from structure import read_structure
+from orchestrate import vasp_finished
 
 def main():
     
+    parser = argparse.ArgumentParser(description='Builds the POSCARs of all steps')
+    parser.add_argument('--adaptive', action='store_true',
+                        help='start from a coarse grid and add steps where the '
+                             'descriptor of the finished steps changes quickly')
+    parser.add_argument('--coarse', type=int, default=31,
+                        help='number of steps of the first adaptive grid')
+    parser.add_argument('--descriptor', default='energy',
+                        choices=sorted(DESCRIPTORS),
+                        help='quantity of the finished steps used to refine')
+    parser.add_argument('--tolerance', type=float, default=None,
+                        help='largest change of the descriptor between two '
+                             'neighbouring steps')
+    parser.add_argument('--min-spacing', type=float, default=None,
+                        help='smallest distance between two steps in Angstrom, '
+                             'default the spacing of the uniform grid')
+    parser.add_argument('--chain', action='store_true',
+                        help='let steps start from the WAVECAR and CHGCAR of '
+                             'a neighbouring step, see chain.py')
+    parser.add_argument('--stride', type=int, default=1,
+                        help='with --chain, every stride-th step starts from '
+                             'scratch and the others from the one below them')
+    parser.add_argument('--from-contcar', action='store_true',
+                        help='start unfinished steps from the relaxed CONTCAR '
+                             'of the nearest finished step')
+    parser.add_argument('--only', default=None,
+                        help='only (re)write these steps, e.g. 12,13')
+    parser.add_argument('--renumber', action='store_true',
+                        help='renumber the adaptive output folders in order '
+                             'of distance')
+    args = parser.parse_args()
+    if args.chain and args.adaptive:
+        parser.error('--chain needs the uniform grid')
+    
     # Setting paths to files
     poscar = os.path.join(os.path.dirname(__file__),'data/POSCAR')
     params = os.path.join(os.path.dirname(__file__),'data/param.txt')
+    output = os.path.join(os.path.dirname(__file__), 'output')
     
     # Settings for linear translation, 0 is equilibrium position
     param = np.loadtxt(params, max_rows=2)
     max_distance = param[0]	# Take first value from param file for the max distance
     steps = int(param[1])	# Take second value from param file for numder of steps
     
+    if args.renumber:
+        renumber(output)
+        return
+    
+    if args.adaptive:
+        tolerance = args.tolerance
+        if tolerance is None:
+            tolerance = DESCRIPTORS[args.descriptor][1]
+        min_spacing = args.min_spacing
+        if min_spacing is None:
+            min_spacing = max_distance/(steps-1)
+        adaptive(poscar, output, max_distance, args.coarse, args.descriptor,
+                 tolerance, min_spacing, args.from_contcar)
+        return
+    
+    only = None
+    if args.only:
+        only = [int(cnt) for cnt in args.only.split(',')]
+    
+    # Steps which have finished are not rewritten when starting from CONTCARs
+    finished = {}
+    if args.from_contcar:
+        finished = finished_steps(output)
+    
     # Writing the files
     cnt = 0
     for d in np.linspace(0, max_distance, steps):
         cnt += 1
+        if (only is not None and cnt not in only) or cnt in finished:
+            continue
+        start = None
+        if args.from_contcar:
+            start = nearest_contcar(output, finished, d)
+        write_step(poscar, output, cnt, d, start)
+    
+    # Without --chain the seed files of an earlier chained build are removed
+    if only is not None:
+        return
+    if args.chain:
+        write_seeds(output, plan_chain(steps, args.stride))
+    else:
+        write_seeds(output, dict((n, None) for n in range(1, steps+1)))
+    
+def write_step(poscar, output, cnt, d, start=None):
+    """
+    Writes the POSCAR and param.txt of one step
+    
+    poscar : reference POSCAR
+    output : directory of the output folders
+    cnt : number of the step
+    d : increase in distance
+    start : relaxed CONTCAR to start from instead of the reference POSCAR
+    """
+    from ase.io.vasp import write_vasp
+    
+    if start is not None:
+        print('Step %i starts from %s' % (cnt, start))
+    CO_on_Rh = change_distance(poscar, d, start)
+    
+    tpath = os.path.join(output, '%i' % cnt)
+    if not os.path.exists(tpath):
+        os.mkdir(tpath)
+    write_vasp(os.path.join(tpath, 'POSCAR'), CO_on_Rh, direct=True)
+    
+    param_path = os.path.join(tpath, 'param.txt')
+    f = open(param_path, 'w')
+    f.write('%f\n' % d)
+    f.close()
+
+def adaptive(poscar, output, max_distance, coarse, descriptor, tolerance,
+             min_spacing, from_contcar=False):
+    """
+    Writes a coarse grid of steps on the first call. Every later call reads
+    the descriptor of the finished steps and adds a step halfway between
+    two neighbouring finished steps where the descriptor changes by more
+    than the tolerance. The folders and distances are listed in
+    output/distances.txt.
+    
+    poscar : reference POSCAR
+    output : directory of the output folders
+    max_distance : largest increase in distance
+    coarse : number of steps of the first grid
+    descriptor : name of the descriptor in DESCRIPTORS
+    tolerance : largest change of the descriptor between neighbouring steps
+    min_spacing : steps are not refined below this distance
+    from_contcar : start new steps from the CONTCAR of the nearest finished
+                   step
+    """
+    index = read_index(output)
+    finished = {}
+    if from_contcar:
+        finished = finished_steps(output)
+    
+    if not index:
+        new = list(np.linspace(0, max_distance, coarse))
+    else:
+        read = DESCRIPTORS[descriptor][0]
+        order = sorted(index, key=lambda cnt: index[cnt])
+        values = dict((cnt, read(os.path.join(output, '%i' % cnt)))
+                      for cnt in order)
         
-        CO_on_Rh = change_distance(poscar, d)
-        
-        tpath = os.path.join(os.path.dirname(__file__), 'output', '%i' % cnt)
-        if not os.path.exists(tpath):
-            os.mkdir(tpath)
-        ase.io.vasp.write_vasp(os.path.join(tpath, 'POSCAR'), CO_on_Rh,
-                               direct=True)
-        
+        new = []
+        for a, b in zip(order[:-1], order[1:]):
+            if values[a] is None or values[b] is None:
+                continue
+            if abs(values[b] - values[a]) > tolerance and \
+               index[b] - index[a] >= 2*min_spacing:
+                new.append((index[a] + index[b])/2)
         
-        param_path = os.path.join(os.path.dirname(__file__),'output/%i/param.txt' % cnt)
-        f = open(param_path, 'w')
-        f.write('%f\n' % d)
-        f.close()
+        unfinished = [cnt for cnt in order if values[cnt] is None]
+        if unfinished:
+            print('Steps without a %s yet: %s' % (descriptor,
+                  ' '.join('%i' % cnt for cnt in unfinished)))
+    
+    cnt = max(index) if index else 0
+    first = cnt + 1
+    for d in new:
+        cnt += 1
+        start = None
+        if from_contcar:
+            start = nearest_contcar(output, finished, d)
+        write_step(poscar, output, cnt, d, start)
+        index[cnt] = d
+    write_index(output, index)
+    
+    if new:
+        print('New steps %i-%i, submit them with --array=%i-%i' %
+              (first, cnt, first, cnt))
+    else:
+        print('No steps added')
+
+def finished_steps(output):
+    """
+    Returns the distance of every step whose VASP run has finished
+    """
+    finished = {}
+    for name in os.listdir(output):
+        folder = os.path.join(output, name)
+        contcar = os.path.join(folder, 'CONTCAR')
+        if not name.isdigit() or not vasp_finished(folder) or \
+           not os.path.isfile(contcar) or not os.path.getsize(contcar) or \
+           not os.path.isfile(os.path.join(folder, 'param.txt')):
+            continue
+        finished[int(name)] = float(np.loadtxt(os.path.join(folder, 'param.txt')))
+    return finished
+
+def nearest_contcar(output, finished, d):
+    """
+    Returns the CONTCAR of the finished step closest to distance d, None if
+    no step has finished
+    """
+    if not finished:
+        return None
+    cnt = min(finished, key=lambda cnt: abs(finished[cnt] - d))
+    return os.path.join(output, '%i' % cnt, 'CONTCAR')
+
+def read_index(output):
+    """
+    Returns the distance of every folder listed in output/distances.txt
+    """
+    path = os.path.join(output, 'distances.txt')
+    index = {}
+    if os.path.isfile(path):
+        with open(path) as f:
+            for line in f:
+                if line.strip() and not line.startswith('#'):
+                    cnt, d = line.split()
+                    index[int(cnt)] = float(d)
+    return index
+
+def write_index(output, index):
+    """
+    Writes the folders and their distances to output/distances.txt, in order
+    of distance
+    """
+    f = open(os.path.join(output, 'distances.txt'), 'w')
+    f.write('# folder distance\n')
+    for cnt in sorted(index, key=lambda cnt: index[cnt]):
+        f.write('%i %f\n' % (cnt, index[cnt]))
+    f.close()
+
+def renumber(output):
+    """
+    Renames the folders listed in output/distances.txt so that they are
+    numbered in order of distance
+    """
+    index = read_index(output)
+    order = sorted(index, key=lambda cnt: index[cnt])
+    
+    # Moving via temporary names, as old and new numbers overlap
+    for cnt in order:
+        os.rename(os.path.join(output, '%i' % cnt),
+                  os.path.join(output, 'renumber_%i' % cnt))
+    new_index = {}
+    for new, cnt in enumerate(order):
+        os.rename(os.path.join(output, 'renumber_%i' % cnt),
+                  os.path.join(output, '%i' % (new+1)))
+        new_index[new+1] = index[cnt]
+    write_index(output, new_index)
+    
+    print('Renumbered %i steps, set the number of steps in data/param.txt '
+          'to %i' % (len(order), len(order)))
+
+def read_energy(folder):
+    """
+    Returns the final free energy in the OSZICAR of a step, None if the step
+    has not finished
+    """
+    # VASP writes the CONTCAR and the OSZICAR during the relaxation, only
+    # the timing summary in the OUTCAR marks the end
+    oszicar = os.path.join(folder, 'OSZICAR')
+    if not vasp_finished(folder) or not os.path.isfile(oszicar):
+        return None
+    energy = None
+    with open(oszicar) as f:
+        for line in f:
+            if 'F=' in line:
+                energy = float(line.split('F=')[1].split()[0])
+    return energy
+
+def read_icohp(folder):
+    """
+    Returns the iCOHP at the Fermi level of the first interaction in the
+    COHPCAR.lobster of a step, None if LOBSTER has not finished
+    """
+    from lobster_io import read_cohpcar, lobster_exists
+    cohpcar = os.path.join(folder, 'COHPCAR.lobster')
+    if not lobster_exists(cohpcar):
+        return None
+    data = read_cohpcar(cohpcar)
+    return float(np.interp(0, data.energies, data.total(1)[1]))
+
+# Descriptors of a finished step and their default tolerance
+DESCRIPTORS = {
+    'energy' : (read_energy, 0.05),
+    'icohp' : (read_icohp, 0.1),
+    }
     
     
-def change_distance(poscar,dist):
+def change_distance(poscar,dist,start=None):
     """
     Changes the distance of a CO molecule to a surface only in z direction
 
     poscar : POSCAR of CO on a surface
     dist : increase in distance
+    start : relaxed CONTCAR of another step, its CO is moved so that C is
+            dist above its height in the POSCAR, keeping the relaxed slab
+            and C-O bond
     """
+    from ase.constraints import FixAtoms, FixedLine, FixedPlane
     
-    ref_struc = ase.io.read(poscar)
+    ref = read_structure(poscar)
 
-    index_C = atom_index(poscar, 'C')
-    index_O = atom_index(poscar, 'O')
+    index_C = ref.index('C')
+    index_O = ref.index('O')
 
-    new_struc = ref_struc.copy()
+    if start is None:
+        new_struc = ref.to_atoms()
+        shift = dist
+    else:
+        new_struc = read_structure(start).to_atoms()
+        shift = ref.positions[index_C][2] + dist \
+                - new_struc.positions[index_C][2]
     
-    new_struc.positions[index_C][2] = new_struc.positions[index_C][2] + dist
-    new_struc.positions[index_O][2] = new_struc.positions[index_O][2] + dist
+    new_struc.positions[index_C][2] = new_struc.positions[index_C][2] + shift
+    new_struc.positions[index_O][2] = new_struc.positions[index_O][2] + shift
 
     constraint_c = FixAtoms(
         [atom.index for atom in new_struc if atom.symbol == 'C']
@@ -67,35 +332,6 @@ def change_distance(poscar,dist):
     new_struc.set_constraint([constraint_c,constraint_o,constraint_rh])
     
     return new_struc
-
-
-def atom_index(poscar,atom_name):
-    """
-    Finds the index of an atom based on the poscar
-    
-    poscar : POSCAR file
-    atom_name : string with a atom to find
-    """
-
-    atoms = np.loadtxt(poscar,dtype=str, skiprows=5, max_rows=1)
-    nr_atoms = np.loadtxt(poscar, skiprows=6, max_rows=1)
-    
-    i_count = 0
-    
-    for i in atoms:
-        if i == atom_name:
-            ind_atom = i_count
-        else:
-            i_count += 1
-    
-    index_atom = 0
-    
-    for j in range(0,ind_atom):
-        index_atom = index_atom + nr_atoms[j]
-        
-    
-    return int(index_atom)
-    
     
     
 if __name__ == '__main__':
@@ -0,0 +1,128 @@
+import os
+import argparse
+import subprocess
+import numpy as np
+
+def main():
+
+    parser = argparse.ArgumentParser(
+        description='Submits the steps so that every step starts after the '
+                    'step it takes its WAVECAR and CHGCAR from')
+    parser.add_argument('--script', default='run',
+                        help='SLURM script running one step')
+    parser.add_argument('--sbatch', default='sbatch',
+                        help='command used to submit the jobs')
+    parser.add_argument('--dry-run', action='store_true',
+                        help='only print the sbatch commands')
+    args = parser.parse_args()
+
+    params = os.path.join(os.path.dirname(__file__),'data/param.txt')
+    output = os.path.join(os.path.dirname(__file__), 'output')
+    steps = int(np.loadtxt(params, max_rows=2)[1])
+
+    plan = read_seeds(output, steps)
+    submit_chain(plan, args.script, args.sbatch, args.dry_run)
+
+def plan_chain(steps, stride=1):
+    """
+    Returns for every step the step it starts from, None for steps which
+    start from scratch
+
+    With stride 1 every step starts from the previous step. With a larger
+    stride the steps 1, 1+stride, 1+2*stride, ... start from scratch and
+    run at the same time, the other steps start from the nearest of these
+    below them.
+
+    steps : number of steps
+    stride : distance between the steps starting from scratch
+    """
+    plan = {}
+    for n in range(1, steps+1):
+        if n == 1:
+            plan[n] = None
+        elif stride == 1:
+            plan[n] = n - 1
+        elif (n - 1) % stride == 0:
+            plan[n] = None
+        else:
+            plan[n] = n - (n - 1) % stride
+    return plan
+
+def write_seeds(output, plan):
+    """
+    Writes the step a step starts from to output/<n>/seed, removes the file
+    for steps starting from scratch
+    """
+    for n, seed in plan.items():
+        path = os.path.join(output, '%i' % n, 'seed')
+        if seed is None:
+            if os.path.isfile(path):
+                os.remove(path)
+        else:
+            with open(path, 'w') as f:
+                f.write('%i\n' % seed)
+
+def read_seeds(output, steps):
+    """
+    Reads the plan written by write_seeds
+    """
+    plan = {}
+    for n in range(1, steps+1):
+        path = os.path.join(output, '%i' % n, 'seed')
+        if os.path.isfile(path):
+            with open(path) as f:
+                plan[n] = int(f.read())
+        else:
+            plan[n] = None
+    return plan
+
+def submit_chain(plan, script='run', sbatch='sbatch', dry_run=False):
+    """
+    Submits the steps starting from scratch as one array job and every other
+    step as its own job depending on the job of its seed
+
+    Returns the job of every step, as used in --dependency
+
+    plan : seed of every step made by plan_chain or read_seeds
+    script : SLURM script running one step
+    sbatch : command used to submit the jobs
+    dry_run : print the commands and number the jobs instead of submitting
+    """
+    jobs = {}
+    counter = [0]
+
+    def submit(array, dependency=None):
+        command = [sbatch, '--parsable', '--array=%s' % array]
+        if dependency:
+            command.append('--dependency=afterok:%s' % dependency)
+        command.append(script)
+        print(' '.join(command))
+        if dry_run:
+            counter[0] += 1
+            return str(counter[0])
+        result = subprocess.run(command, check=True, capture_output=True,
+                                text=True)
+        # --parsable prints jobid or jobid;cluster
+        return result.stdout.strip().split(';')[0]
+
+    roots = [n for n in sorted(plan) if plan[n] is None]
+    if roots:
+        job = submit(','.join('%i' % n for n in roots))
+        for n in roots:
+            jobs[n] = '%s_%i' % (job, n)
+
+    # Submitting in an order where the seed of a step is always submitted
+    # before the step itself
+    pending = [n for n in sorted(plan) if plan[n] is not None]
+    while pending:
+        ready = [n for n in pending if plan[n] in jobs]
+        if not ready:
+            raise Exception('Seeds of steps %s are never run' % pending)
+        for n in ready:
+            jobs[n] = submit('%i' % n, jobs[plan[n]])
+            pending.remove(n)
+
+    return jobs
+
+if __name__ == '__main__':
+    main()
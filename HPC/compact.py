@@ -0,0 +1,124 @@
+import os
+import gzip
+import shutil
+import argparse
+import numpy as np
+from chain import read_seeds
+from orchestrate import parse_steps, vasp_finished, lobster_finished
+from lobster_io import compact_doscar, compact_cohpcar
+
+# What happens to the WAVECAR and CHGCAR of a finished step
+RESTART_POLICIES = ['keep', 'gzip', 'delete']
+
+def main():
+
+    parser = argparse.ArgumentParser(
+        description='Converts the LOBSTER output of finished steps to '
+                    'compressed .npz files and compacts the VASP restart files')
+    parser.add_argument('--steps', default=None,
+                        help='steps to compact, e.g. 1-10,15, default all')
+    parser.add_argument('--restart', default='keep', choices=RESTART_POLICIES,
+                        help='what to do with WAVECAR and CHGCAR, they are '
+                             'kept while a chained step still needs them')
+    parser.add_argument('--keep-text', action='store_true',
+                        help='keep the text files next to the .npz files')
+    args = parser.parse_args()
+
+    params = os.path.join(os.path.dirname(__file__),'data/param.txt')
+    output = os.path.join(os.path.dirname(__file__), 'output')
+    nsteps = int(np.loadtxt(params, max_rows=2)[1])
+
+    steps = range(1, nsteps+1)
+    if args.steps:
+        steps = parse_steps(args.steps)
+
+    seeds = read_seeds(output, nsteps)
+
+    # The seed of a step may be waiting for this step before its restart
+    # files can go
+    restart_steps = set(steps)
+    restart_steps.update(seeds[n] for n in steps if seeds.get(n))
+
+    saved = 0
+    for n in steps:
+        saved += compact_lobster(os.path.join(output, '%i' % n),
+                                 args.keep_text)
+    if args.restart != 'keep':
+        for n in sorted(restart_steps):
+            waiting = [m for m in seeds if seeds[m] == n and
+                       not vasp_finished(os.path.join(output, '%i' % m))]
+            if waiting:
+                print('Step %i: restart files kept for steps %s' % (n, waiting))
+                continue
+            saved += compact_restart(os.path.join(output, '%i' % n),
+                                     args.restart)
+    print('Saved %.1f MB' % (saved / 1e6))
+
+def compact_lobster(folder, keep_text=False):
+    """
+    Converts DOSCAR.lobster and COHPCAR.lobster of a folder to compressed
+    .npz files, read by lobster_io when the text files are gone. The text
+    files are removed only after the .npz files read back the same values.
+
+    Returns the number of bytes saved.
+
+    folder : output folder of a step
+    keep_text : keep the text files
+    """
+    if not vasp_finished(folder) or not lobster_finished(folder):
+        return 0
+
+    saved = 0
+    doscar = os.path.join(folder, 'DOSCAR.lobster')
+    if os.path.isfile(doscar):
+        compact_doscar(doscar)
+        saved += _remove(doscar, keep_text)
+        # The parse cache of read_doscar is only used next to the text file
+        if not keep_text and os.path.isfile(doscar + '.cache.npz'):
+            saved += _remove(doscar + '.cache.npz')
+
+    cohpcar = os.path.join(folder, 'COHPCAR.lobster')
+    if os.path.isfile(cohpcar):
+        compact_cohpcar(cohpcar)
+        saved += _remove(cohpcar, keep_text)
+    return saved
+
+def compact_restart(folder, policy):
+    """
+    Compresses or deletes the WAVECAR and CHGCAR of a folder once LOBSTER,
+    which reads the WAVECAR, has finished
+
+    Returns the number of bytes saved.
+    """
+    if policy not in RESTART_POLICIES:
+        raise Exception('Unknown restart policy: %s' % policy)
+    if policy == 'keep' or not lobster_finished(folder):
+        return 0
+
+    saved = 0
+    for name in ['WAVECAR', 'CHGCAR']:
+        path = os.path.join(folder, name)
+        if not os.path.isfile(path):
+            continue
+        if policy == 'gzip':
+            # The fastest level, these files are large and compress poorly
+            temp = path + '.gz.%i.tmp' % os.getpid()
+            with open(path, 'rb') as f, gzip.open(temp, 'wb', 1) as g:
+                shutil.copyfileobj(f, g, 2**24)
+            os.replace(temp, path + '.gz')
+            saved -= os.path.getsize(path + '.gz')
+        saved += _remove(path)
+    return saved
+
+def _remove(path, keep=False):
+    """
+    Removes a file and returns its size
+    """
+    if keep:
+        return 0
+    size = os.path.getsize(path)
+    os.remove(path)
+    return size
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,437 @@
+import os
+import re
+import numpy as np
+
+# Interaction lines of a COHPCAR.lobster header
+ORBITALWISE = re.compile(r'No.([0-9]+):([A-Za-z]{1,2})([0-9]+)\[([0-9][spdf]_?[a-z^2-]*)\]->([A-Za-z]{1,2})([0-9]+)\[([0-9][spdf]_?[a-z-^2]*)\].*')
+TOTAL = re.compile(r'No.([0-9]+):([A-Za-z]{1,2})([0-9]+)->([A-Za-z]{1,2})([0-9]+).*')
+
+def read_doscar(filename, atoms=None, cache=True):
+    """
+    Reads the energies and the projected DOS of a set of atoms from a
+    DOSCAR.lobster file in one pass
+
+    filename : DOSCAR.lobster file
+    atoms : list of atom indices (0-based), None reads all atoms
+    cache : use and write a DOSCAR.lobster.cache.npz sidecar next to the
+            DOSCAR.lobster file
+    """
+    sidecar = filename + '.cache.npz'
+    if not os.path.isfile(filename):
+        # Only the compact form left by compact.py
+        cached = load_doscar_sidecar(filename + '.npz')
+        if cached is None:
+            raise Exception('No DOSCAR.lobster found: %s' % filename)
+        energies, blocks, columns = cached
+        return _select(energies, blocks, columns, atoms)
+    if cache:
+        cached = load_doscar_sidecar(sidecar, filename)
+        if cached is not None:
+            energies, blocks, columns = cached
+            if atoms is None or all(i in blocks for i in atoms):
+                return _select(energies, blocks, columns, atoms)
+
+    with open(filename, 'rb') as f:
+        buf = f.read()
+    index = _index(buf, filename)
+
+    # Parsing all blocks when writing a sidecar, so that every later request
+    # for any atom is served from the cache
+    if cache or atoms is None:
+        wanted = range(index['natoms'])
+    else:
+        wanted = atoms
+
+    energies = None
+    blocks = {}
+    for i in wanted:
+        start, end = index['offsets'][i]
+        block = _parse_block(buf[start:end], index['nedos'])
+        energies = block[:,0]
+        blocks[i] = block[:,1:]
+
+    columns = dict((i,index['columns'][i]) for i in blocks)
+
+    if cache:
+        # A read-only output folder should not stop the analysis
+        try:
+            save_doscar_sidecar(sidecar, filename, energies, blocks, columns)
+        except OSError:
+            pass
+
+    return _select(energies, blocks, columns, atoms)
+
+def lobster_exists(filename):
+    """
+    Returns whether a LOBSTER output exists as text or in compact form
+    """
+    return os.path.isfile(filename) or compact_exists(filename)
+
+def compact_exists(filename):
+    """
+    Returns whether compact.py has written the compact form of a LOBSTER
+    output, filename.npz. The sidecar of read_doscar is named
+    filename.cache.npz, so removing it never loses data.
+    """
+    return os.path.isfile(filename + '.npz')
+
+def lobster_path(filename):
+    """
+    Returns the file a LOBSTER output is read from, the text file if it is
+    there and the compact form otherwise
+    """
+    if not os.path.isfile(filename) and compact_exists(filename):
+        return filename + '.npz'
+    return filename
+
+def index_doscar(filename):
+    """
+    Parses the header of a DOSCAR.lobster file and builds a byte-offset index
+    of the per-atom blocks
+
+    filename : DOSCAR.lobster file
+    """
+    with open(filename, 'rb') as f:
+        buf = f.read()
+    return _index(buf, filename)
+
+def _index(buf, filename):
+    """
+    Builds the index of index_doscar from the contents of a DOSCAR.lobster
+    """
+    if not buf.endswith(b'\n'):
+        buf = buf + b'\n'
+
+    # Start of every line in the file
+    newlines = np.flatnonzero(np.frombuffer(buf, dtype=np.uint8) == ord('\n'))
+    starts = np.concatenate(([0], newlines + 1))
+
+    natoms = int(buf[:newlines[0]].split()[0])
+    header = buf[starts[5]:newlines[5]].split(b';')[0].split()
+    nedos = int(header[2])
+    efermi = float(header[3])
+
+    # Line numbers of the atom headers, after 5 header lines, the energy line
+    # and the total DOS block
+    first = 6 + nedos
+    offsets = []
+    columns = []
+    for i in range(natoms):
+        line = first + i*(nedos+1)
+        if line + nedos >= len(starts):
+            raise Exception('DOSCAR.lobster is truncated: %s' % filename)
+        offsets.append((int(starts[line+1]), int(starts[line+1+nedos])))
+        columns.append(_orbital_names(buf[starts[line]:newlines[line]]))
+
+    return {
+        'natoms' : natoms,
+        'nedos' : nedos,
+        'efermi' : efermi,
+        'total' : (int(starts[6]), int(starts[6+nedos])),
+        'offsets' : offsets,
+        'columns' : columns,
+        }
+
+def load_doscar_sidecar(sidecar, filename=None):
+    """
+    Loads a .npz sidecar, returns None if it is missing or older than the
+    DOSCAR.lobster file it was made from
+
+    sidecar : .npz file written by save_doscar_sidecar
+    filename : DOSCAR.lobster the sidecar belongs to
+    """
+    if not os.path.isfile(sidecar):
+        return None
+
+    with np.load(sidecar) as data:
+        if filename is not None and os.path.isfile(filename):
+            stat = os.stat(filename)
+            if data['source'][0] != stat.st_mtime_ns or \
+               data['source'][1] != stat.st_size:
+                return None
+
+        energies = data['energies']
+        blocks = {}
+        columns = {}
+        for i in data['atoms']:
+            blocks[int(i)] = data['atom_%i' % i]
+            columns[int(i)] = list(data['columns_%i' % i])
+
+    return energies, blocks, columns
+
+def save_doscar_sidecar(sidecar, filename, energies, blocks, columns,
+                        compress=False, extra=None):
+    """
+    Writes parsed DOSCAR.lobster blocks to a .npz sidecar
+
+    extra : further arrays to store, e.g. the total DOS and header lines
+    """
+    stat = os.stat(filename)
+    arrays = {
+        'source' : np.array([stat.st_mtime_ns, stat.st_size], dtype=np.int64),
+        'energies' : energies,
+        'atoms' : np.array(sorted(blocks), dtype=int),
+        }
+    for i in blocks:
+        arrays['atom_%i' % i] = blocks[i]
+        arrays['columns_%i' % i] = np.array(columns[i], dtype=str)
+    if extra:
+        arrays.update(extra)
+    _savez(sidecar, arrays, compress)
+
+def _savez(path, arrays, compress=False):
+    """
+    Writes arrays to a .npz file
+    """
+    # Writing to a temporary file first so parallel readers never see half a
+    # file
+    temp = path + '.%i.tmp' % os.getpid()
+    with open(temp, 'wb') as f:
+        if compress:
+            np.savez_compressed(f, **arrays)
+        else:
+            np.savez(f, **arrays)
+    os.replace(temp, path)
+
+def compact_doscar(filename):
+    """
+    Writes all blocks of a DOSCAR.lobster, including the total DOS and the
+    header lines, to filename.npz and checks that it reads back the same
+    """
+    with open(filename, 'rb') as f:
+        buf = f.read()
+    index = _index(buf, filename)
+    nedos = index['nedos']
+
+    start, end = index['total']
+    total = _parse_block(buf[start:end], nedos)
+    header = buf[:start].decode().split('\n')[:6]
+    blocks = {}
+    headers = []
+    for i, (start, end) in enumerate(index['offsets']):
+        blocks[i] = _parse_block(buf[start:end], nedos)
+        # The atom header is the line ending just before its block
+        line = buf.rfind(b'\n', 0, start-1) + 1
+        headers.append(buf[line:start-1].decode())
+    energies = total[:,0]
+    columns = dict((i, index['columns'][i]) for i in blocks)
+
+    sidecar = filename + '.npz'
+    save_doscar_sidecar(sidecar, filename, energies,
+                        dict((i, b[:,1:]) for i, b in blocks.items()), columns,
+                        compress=True, extra={
+                            'total' : total[:,1:],
+                            'header' : np.array(header),
+                            'atom_headers' : np.array(headers),
+                            })
+
+    # Round trip through the reader used by the analysis
+    cached = load_doscar_sidecar(sidecar, filename)
+    if cached is None:
+        raise Exception('Cannot read back %s' % sidecar)
+    e, loaded, names = cached
+    with np.load(sidecar) as data:
+        same = np.array_equal(data['total'], total[:,1:])
+    same = same and np.array_equal(e, energies) and \
+           sorted(loaded) == sorted(blocks) and \
+           all(np.array_equal(loaded[i], blocks[i][:,1:]) and
+               names[i] == columns[i] for i in blocks)
+    if not same:
+        os.remove(sidecar)
+        raise Exception('Compact DOSCAR.lobster differs from %s' % filename)
+
+def compact_cohpcar(filename):
+    """
+    Writes a COHPCAR.lobster with its header lines to filename.npz and checks
+    that it reads back the same
+    """
+    data = read_cohpcar(filename)
+    path = filename + '.npz'
+    save_cohpcar_compact(path, data, cohpcar_header(filename))
+
+    loaded = load_cohpcar_compact(path)
+    if not (np.array_equal(loaded.energies, data.energies) and
+            np.array_equal(loaded.cohp, data.cohp) and
+            np.array_equal(loaded.icohp, data.icohp) and
+            np.array_equal(loaded.metadata, data.metadata) and
+            loaded.types == data.types):
+        os.remove(path)
+        raise Exception('Compact COHPCAR.lobster differs from %s' % filename)
+
+class CohpData:
+    """
+    Columnar contents of a COHPCAR.lobster file
+
+    energies : energies (nedos)
+    cohp : COHP per spin and interaction (nspin, nrints, nedos), interaction
+           0 is the average and interaction i+1 belongs to types[i]
+    icohp : integrated COHP with the same layout as cohp
+    types : list of dicts describing the interactions
+    metadata : numbers on the second line of the file
+    """
+    def __init__(self, energies, cohp, icohp, types, metadata):
+        self.energies = energies
+        self.cohp = cohp
+        self.icohp = icohp
+        self.types = types
+        self.metadata = metadata
+
+    @property
+    def nrints(self):
+        return self.cohp.shape[1]
+
+    @property
+    def spinpol(self):
+        return self.cohp.shape[0] > 1
+
+    def total(self, interaction):
+        """
+        Returns COHP and iCOHP of an interaction summed over the spins
+        """
+        return self.cohp[:,interaction].sum(axis=0), \
+               self.icohp[:,interaction].sum(axis=0)
+
+def read_cohpcar(filename, chunk_size=2**24):
+    """
+    Reads a COHPCAR.lobster file in a single streaming pass
+
+    filename : COHPCAR.lobster file
+    chunk_size : number of bytes of the numeric body parsed at once
+    """
+    if not os.path.isfile(filename) and os.path.isfile(filename + '.npz'):
+        # Only the compact form left by compact.py
+        return load_cohpcar_compact(filename + '.npz')
+
+    with open(filename, 'rb') as f:
+        f.readline()                                  # skip first line
+        metadata = np.array(f.readline().split(), dtype=float)
+        nrints = int(metadata[0])
+        nspin = int(metadata[1])
+        nedos = int(metadata[2])
+        f.readline()                                  # skip average line
+
+        types = []
+        for i in range(1, nrints):
+            types.append(_interaction(f.readline().decode()))
+
+        # Parsing the body chunk by chunk into a preallocated array keeps the
+        # peak memory at one copy of the data
+        ncols = 1 + 2*nrints*nspin
+        values = np.empty(nedos*ncols)
+        filled = 0
+        rest = b''
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            chunk = rest + chunk
+            cut = chunk.rfind(b'\n') + 1
+            rest = chunk[cut:]
+            filled = _fill(values, filled, chunk[:cut], filename)
+        filled = _fill(values, filled, rest, filename)
+
+    if filled != values.size:
+        raise Exception('COHPCAR.lobster is truncated: %s' % filename)
+
+    columns = values.reshape(nedos, ncols).T
+    energies = columns[0].copy()
+    pairs = columns[1:].reshape(nspin, nrints, 2, nedos)
+    cohp = np.ascontiguousarray(pairs[:,:,0])
+    icohp = np.ascontiguousarray(pairs[:,:,1])
+
+    return CohpData(energies, cohp, icohp, types, metadata)
+
+def cohpcar_header(filename):
+    """
+    Returns the header lines of a COHPCAR.lobster file: the first line, the
+    numbers line, the average line and one line per interaction
+    """
+    with open(filename, 'rb') as f:
+        header = [f.readline().decode(), f.readline().decode()]
+        nrints = int(float(header[1].split()[0]))
+        for i in range(nrints):
+            header.append(f.readline().decode())
+    return [line.rstrip('\n') for line in header]
+
+def save_cohpcar_compact(path, data, header, compress=True):
+    """
+    Writes a CohpData object and the header lines of its COHPCAR.lobster to
+    a .npz file
+    """
+    _savez(path, {
+        'energies' : data.energies,
+        'cohp' : data.cohp,
+        'icohp' : data.icohp,
+        'metadata' : data.metadata,
+        'header' : np.array(header, dtype=str),
+        }, compress)
+
+def load_cohpcar_compact(path):
+    """
+    Reads a .npz file written by save_cohpcar_compact as a CohpData object
+    """
+    with np.load(path) as data:
+        header = list(data['header'])
+        types = [_interaction(line) for line in header[3:]]
+        return CohpData(data['energies'], data['cohp'], data['icohp'], types,
+                        data['metadata'])
+
+def _interaction(line):
+    """
+    Parses an interaction line of a COHPCAR.lobster header
+    """
+    m = ORBITALWISE.match(line)
+    if m:
+        return {
+            'type' : 'orbitalwise',
+            'interaction_id' : int(m.group(1)),
+            'element1' : m.group(2),
+            'atomid1' : int(m.group(3)),
+            'orbital1' : m.group(4),
+            'element2' : m.group(5),
+            'atomid2' : int(m.group(6)),
+            'orbital2' : m.group(7),
+            }
+    m = TOTAL.match(line)
+    if m:
+        return {
+            'type' : 'total',
+            'interaction_id' : int(m.group(1)),
+            'element1' : m.group(2),
+            'atomid1' : int(m.group(3)),
+            'element2' : m.group(4),
+            'atomid2' : int(m.group(5)),
+            }
+    raise Exception('Cannot parse line: %s' % line)
+
+def _fill(values, filled, chunk, filename):
+    """
+    Parses whitespace separated floats into values starting at filled
+    """
+    parsed = np.fromstring(chunk, sep=' ')
+    if filled + parsed.size > values.size:
+        raise Exception('COHPCAR.lobster has too many values: %s' % filename)
+    values[filled:filled+parsed.size] = parsed
+    return filled + parsed.size
+
+def _parse_block(chunk, nedos):
+    """
+    Parses a block of whitespace separated floats into nedos rows
+    """
+    values = np.fromstring(chunk, sep=' ')
+    return values.reshape(nedos, -1)
+
+def _orbital_names(line):
+    """
+    Gets the orbital names from an atom header line
+    """
+    parts = line.decode().split(';')
+    if len(parts) < 3:
+        return []
+    return parts[-1].split()
+
+def _select(energies, blocks, columns, atoms):
+    if atoms is None:
+        atoms = sorted(blocks)
+    return energies, dict((i,blocks[i]) for i in atoms), \
+           dict((i,columns[i]) for i in atoms)
@@ -0,0 +1,309 @@
+import os
+import sys
+import argparse
+import threading
+import subprocess
+import numpy as np
+from chain import read_seeds
+from lobster_io import compact_exists
+
+# States of a step, kept in output/<n>/state
+STATES = ['pending', 'running', 'vasp_done', 'lobster_done', 'failed']
+
+def main():
+
+    parser = argparse.ArgumentParser(
+        description='Runs the steps of data/param.txt packed into few jobs, '
+                    'keeps the state of every step and resubmits failures')
+    parser.add_argument('command', choices=['submit', 'worker', 'status'])
+    parser.add_argument('--steps', default=None,
+                        help='steps to run, e.g. 1-10,15, default all '
+                             'unfinished steps')
+    parser.add_argument('--per-job', type=int, default=4,
+                        help='number of steps packed into one job')
+    parser.add_argument('--groups', type=int, default=1,
+                        help='number of steps running at the same time in a '
+                             'job, each on ntasks/groups ranks')
+    parser.add_argument('--ntasks', type=int, default=None,
+                        help='MPI ranks of a job, default SLURM_NTASKS or 16')
+    parser.add_argument('--max-retries', type=int, default=2,
+                        help='number of times a failed step is resubmitted')
+    parser.add_argument('--script', default='run',
+                        help='script running one step')
+    parser.add_argument('--job-script', default='run_packed',
+                        help='SLURM script running the worker')
+    parser.add_argument('--sbatch', default='sbatch',
+                        help='command used to submit the jobs')
+    parser.add_argument('--local', action='store_true',
+                        help='run the jobs one after another on this machine '
+                             'instead of submitting them')
+    parser.add_argument('--requeue-running', action='store_true',
+                        help='treat steps left running by a killed job as '
+                             'failed')
+    parser.add_argument('--dry-run', action='store_true',
+                        help='only print the sbatch commands')
+    args = parser.parse_args()
+
+    params = os.path.join(os.path.dirname(__file__),'data/param.txt')
+    output = os.path.join(os.path.dirname(__file__), 'output')
+    nsteps = int(np.loadtxt(params, max_rows=2)[1])
+
+    steps = range(1, nsteps+1)
+    if args.steps:
+        steps = parse_steps(args.steps)
+
+    ntasks = args.ntasks
+    if ntasks is None:
+        ntasks = int(os.environ.get('SLURM_NTASKS', 16))
+
+    if args.command == 'status':
+        states = dict((n, read_state(output, n)[0]) for n in steps)
+        for state in STATES:
+            found = [n for n in steps if states[n] == state]
+            print('%-12s %4i %s' % (state, len(found), format_steps(found)))
+        return
+
+    if args.command == 'worker':
+        run_steps(output, steps, args.script, ntasks, args.groups)
+        failed = retry_steps(output, steps, args.max_retries)
+        if failed:
+            print('Resubmitting steps %s' % format_steps(failed))
+            args.command = 'submit'
+            steps = failed
+        else:
+            return
+
+    todo = retry_steps(output, steps, args.max_retries, args.requeue_running)
+    submit(output, todo, args.per_job, args.groups, ntasks, args.max_retries,
+           args.job_script, args.sbatch, args.local, args.dry_run, args.script)
+
+def parse_steps(text):
+    """
+    Parses a selection of steps like 1-10,15
+    """
+    steps = []
+    for part in text.split(','):
+        if '-' in part:
+            first, last = part.split('-')
+            steps.extend(range(int(first), int(last)+1))
+        else:
+            steps.append(int(part))
+    return sorted(set(steps))
+
+def format_steps(steps):
+    """
+    Writes steps in the format read by parse_steps
+    """
+    parts = []
+    for n in sorted(steps):
+        if parts and parts[-1][1] == n - 1:
+            parts[-1][1] = n
+        else:
+            parts.append([n, n])
+    return ','.join('%i' % a if a == b else '%i-%i' % (a, b) for a, b in parts)
+
+def vasp_finished(folder):
+    """
+    Returns whether the VASP run in a folder has finished
+    """
+    outcar = os.path.join(folder, 'OUTCAR')
+    if not os.path.isfile(outcar):
+        return False
+
+    # VASP writes its timing summary at the very end of a run
+    with open(outcar, 'rb') as f:
+        f.seek(max(os.path.getsize(outcar) - 20000, 0))
+        return b'General timing and accounting' in f.read()
+
+def lobster_finished(folder):
+    """
+    Returns whether LOBSTER has written the files used by the analysis
+    """
+    for name in ['DOSCAR.lobster', 'COHPCAR.lobster']:
+        path = os.path.join(folder, name)
+        # compact.py replaces the text files by .npz files
+        if compact_exists(path):
+            continue
+        if not os.path.isfile(path) or not os.path.getsize(path):
+            return False
+    return True
+
+def read_state(output, n):
+    """
+    Returns the state of a step and the number of times it was started
+    """
+    folder = os.path.join(output, '%i' % n)
+    path = os.path.join(folder, 'state')
+    if not os.path.isfile(path):
+        # Steps run before the orchestrator was used
+        if vasp_finished(folder) and lobster_finished(folder):
+            return 'lobster_done', 0
+        if vasp_finished(folder):
+            return 'vasp_done', 0
+        return 'pending', 0
+    with open(path) as f:
+        state, attempts = f.read().split()[:2]
+    return state, int(attempts)
+
+def write_state(output, n, state, attempts):
+    """
+    Writes the state of a step, replacing the file so other jobs never read
+    half of it
+    """
+    if state not in STATES:
+        raise Exception('Unknown state: %s' % state)
+    path = os.path.join(output, '%i' % n, 'state')
+    temp = path + '.%i.tmp' % os.getpid()
+    with open(temp, 'w') as f:
+        f.write('%s %i\n' % (state, attempts))
+    os.replace(temp, path)
+
+def retry_steps(output, steps, max_retries, requeue_running=False):
+    """
+    Returns the steps which still have to run and have retries left
+
+    Steps which are running are left alone unless requeue_running is set,
+    steps whose VASP run has finished only need LOBSTER again.
+    """
+    todo = []
+    for n in steps:
+        if not os.path.isfile(os.path.join(output, '%i' % n, 'POSCAR')):
+            print('Step %i has no POSCAR, run build_poscars.py first' % n)
+            continue
+        state, attempts = read_state(output, n)
+        if state == 'lobster_done':
+            continue
+        if state == 'running' and not requeue_running:
+            continue
+        if attempts > max_retries:
+            print('Step %i failed %i times, not resubmitting' % (n, attempts))
+            continue
+        todo.append(n)
+    return todo
+
+def submit(output, steps, per_job=4, groups=1, ntasks=16, max_retries=2,
+           job_script='run_packed', sbatch='sbatch', local=False,
+           dry_run=False, script='run'):
+    """
+    Packs the steps into jobs of per_job steps and submits them
+
+    output : directory of the output folders
+    steps : steps to run
+    per_job : number of steps in one job
+    groups : number of steps running at the same time in a job
+    ntasks : MPI ranks of a job
+    max_retries : number of times a failed step is resubmitted
+    job_script : SLURM script running the worker
+    sbatch : command used to submit the jobs
+    local : run the workers one after another on this machine
+    dry_run : print the commands instead of submitting
+    script : script running one step, passed on to the workers together
+             with job_script and sbatch for their resubmissions
+    """
+    base = os.path.dirname(os.path.abspath(__file__))
+    for i in range(0, len(steps), per_job):
+        chunk = steps[i:i+per_job]
+        options = ['--steps', format_steps(chunk), '--groups', '%i' % groups,
+                   '--ntasks', '%i' % ntasks, '--max-retries', '%i' % max_retries,
+                   '--script', script, '--job-script', job_script,
+                   '--sbatch', sbatch]
+
+        if local:
+            command = [sys.executable, os.path.join(base, 'orchestrate.py'),
+                       'worker', '--local'] + options
+        else:
+            command = [sbatch, '--parsable', '--ntasks=%i' % ntasks,
+                       job_script] + options
+        print(' '.join(command))
+        if dry_run:
+            continue
+
+        for n in chunk:
+            write_state(output, n, 'pending', read_state(output, n)[1])
+        subprocess.run(command, check=True, cwd=base)
+
+def run_steps(output, steps, script='run', ntasks=16, groups=1):
+    """
+    Runs steps inside one allocation, groups of them at the same time on
+    ntasks/groups ranks each. A step whose seed is also in steps waits for
+    the seed to finish.
+
+    output : directory of the output folders
+    steps : steps to run
+    script : script running one step
+    ntasks : MPI ranks of the allocation
+    groups : number of steps running at the same time
+    """
+    seeds = read_seeds(output, max(steps))
+    ranks = max(ntasks // groups, 1)
+    waiting = list(steps)
+    busy = set()
+    condition = threading.Condition()
+
+    def next_step():
+        # A step is ready when its seed is not run by this job or has ended
+        for n in waiting:
+            if seeds.get(n) not in waiting and seeds.get(n) not in busy:
+                waiting.remove(n)
+                busy.add(n)
+                return n
+        return None
+
+    def group():
+        while True:
+            with condition:
+                n = next_step()
+                while n is None and waiting:
+                    condition.wait()
+                    n = next_step()
+                if n is None:
+                    return
+            try:
+                run_step(output, n, script, ranks)
+            finally:
+                with condition:
+                    busy.discard(n)
+                    condition.notify_all()
+
+    threads = [threading.Thread(target=group) for g in range(groups)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+def run_step(output, n, script='run', ntasks=16):
+    """
+    Runs one step with the script used for the array jobs and records its
+    state. Steps whose VASP run has finished only run LOBSTER.
+    """
+    base = os.path.dirname(os.path.abspath(__file__))
+    folder = os.path.join(output, '%i' % n)
+    state, attempts = read_state(output, n)
+
+    env = dict(os.environ)
+    env['SLURM_ARRAY_TASK_ID'] = '%i' % n
+    env['SLURM_NTASKS'] = '%i' % ntasks
+    if state == 'vasp_done' and vasp_finished(folder):
+        env['SKIP_VASP'] = '1'
+
+    write_state(output, n, 'running', attempts + 1)
+    # Whole lines, so the output of groups running at once is not mixed
+    print('Step %i started on %i ranks\n' % (n, ntasks), end='')
+    sys.stdout.flush()
+    with open(os.path.join(folder, 'out'), 'a') as log:
+        subprocess.run(['bash', script], cwd=base, env=env, stdout=log,
+                       stderr=subprocess.STDOUT)
+
+    if vasp_finished(folder) and lobster_finished(folder):
+        state = 'lobster_done'
+    elif vasp_finished(folder):
+        state = 'vasp_done'
+    else:
+        state = 'failed'
+    write_state(output, n, state, attempts + 1)
+    print('Step %i %s\n' % (n, state), end='')
+    sys.stdout.flush()
+    return state
+
+if __name__ == '__main__':
+    main()
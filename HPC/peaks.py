@@ -0,0 +1,229 @@
+import numpy as np
+
+def sigma_pi(data_c, data_o):
+    """
+    Combines the s, p_y, p_z and p_x DOS of C and O into sigma and pi
+
+    data_c, data_o : DOS of C and O, the last axis holds 2s 2p_y 2p_z 2p_x
+    """
+    data = data_c + data_o
+    sigma = data[...,0] + data[...,2]
+    pi = data[...,3] + data[...,1]
+    return sigma, pi
+
+def integrate_dos(dos, energies):
+    """
+    Integrates the DOS along the last axis
+
+    dos : DOS of one step (energies) or of many steps (steps, energies)
+    energies : energies of the DOS
+    """
+    dx = (abs(energies[0]) + abs(energies[-1])) / float(len(energies))
+    return np.cumsum(dos, axis=-1) * dx
+
+def peak_table(dos, energies, threshold, offset=None):
+    """
+    Finds the peaks of the DOS of one or many steps at once. A peak is a
+    range of energies where |DOS| is at least the threshold.
+
+    Returns a dict of arrays with one entry per peak:
+    step : row of the dos the peak belongs to
+    start, end : first and last index of the peak
+    significant : whether the integrated DOS changes over the peak
+    max_index : index of the maximum of the DOS in the peak
+    x : position of the label, maximum of the DOS plus 0.1
+    height : energy of the label, middle of the peak minus 0.5
+    energy : energy of the maximum of the peak
+
+    dos : DOS of one step (energies) or of many steps (steps, energies)
+    energies : energies of the DOS
+    threshold : minimum |DOS| of a peak
+    offset : DOS plotted below this one, added to x at max_index
+    """
+    dos = np.atleast_2d(dos)
+    steps, nedos = dos.shape
+
+    # Edges of the threshold mask, padded so peaks touching the ends of the
+    # energy range are closed
+    mask = np.zeros((steps, nedos+2), dtype=np.int8)
+    mask[:,1:-1] = np.abs(dos) >= threshold
+    edges = np.diff(mask, axis=1)
+    step, start = np.nonzero(edges == 1)
+    end = np.nonzero(edges == -1)[1] - 1
+
+    idos = integrate_dos(dos, energies)
+    significant = np.abs(idos[step,end] - idos[step,start]) > 0.00001
+
+    # Maximum of every peak over [start, end) with one reduceat on the
+    # flattened DOS, taking every other result
+    flat = dos.ravel()
+    first = step*nedos + start
+    last = step*nedos + end
+    if len(first):
+        bounds = np.column_stack([first, last]).ravel()
+        peak_max = np.maximum.reduceat(flat, bounds)[::2]
+    else:
+        peak_max = np.zeros(0)
+
+    # First index in every peak that reaches the maximum
+    lengths = np.maximum(end - start, 1)
+    segment = np.repeat(np.arange(len(first)), lengths)
+    position = np.repeat(first, lengths) + np.arange(lengths.sum()) \
+               - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    hits = np.flatnonzero(flat[position] == peak_max[segment])
+    hit_segment, hit_first = np.unique(segment[hits], return_index=True)
+    max_index = position[hits[hit_first]] - step*nedos
+
+    x = peak_max + 0.1
+    if offset is not None:
+        x = x + np.atleast_2d(offset)[step,max_index]
+
+    height = energies[start] + np.abs(energies[start] - energies[end])/2.0 - 0.5
+    energy = energies[max_index]
+
+    return {
+        'step' : step,
+        'start' : start,
+        'end' : end,
+        'significant' : significant,
+        'max_index' : max_index,
+        'x' : x,
+        'height' : height,
+        'energy' : energy,
+        }
+
+def select_step(table, step):
+    """
+    Returns the rows of a peak table belonging to one step
+    """
+    rows = table['step'] == step
+    return dict((k, v[rows]) for k, v in table.items())
+
+def trajectory_peaks(store, c_index, o_index, thresholds=(0.9,1.2)):
+    """
+    Returns the peak tables of the sigma and pi DOS of all steps in a
+    trajectory store in one call
+
+    store : store opened with trajectory.open_store
+    c_index, o_index : indices of the C and O atoms
+    thresholds : minimum |DOS| of a sigma and of a pi peak
+    """
+    e = np.array(store.dos_energies)
+    sigma, pi = sigma_pi(store.dos[:,:,store.dos_columns(c_index)],
+                         store.dos[:,:,store.dos_columns(o_index)])
+    return peak_table(sigma, e, thresholds[0]), \
+           peak_table(pi, e, thresholds[1], offset=sigma)
+
+def track_peaks(table, names, max_shift=1.5):
+    """
+    Links the significant peaks of neighbouring steps into tracks, so every
+    peak keeps the same identity along the trajectory. Peaks of a step are
+    matched to the last position of the existing tracks by solving an
+    assignment problem on the energy difference.
+
+    Returns the track of every row of the table (-1 for peaks which are not
+    significant) and the names of the tracks. The peaks of the first step
+    with significant peaks get the names in order of energy, tracks started
+    later on are named peak<n>.
+
+    table : peak table of all steps made by peak_table
+    names : names of the tracks, in order of energy
+    max_shift : largest energy change in eV of a peak between two steps
+    """
+    track = np.full(len(table['step']), -1)
+    names = list(names)
+    track_names = []
+    last = []
+
+    for step in np.unique(table['step']):
+        rows = np.flatnonzero((table['step'] == step) & table['significant'])
+        energy = table['energy'][rows]
+
+        matched = np.zeros(len(rows), dtype=bool)
+        if len(last) and len(rows):
+            cost = np.abs(np.subtract.outer(np.array(last), energy))
+            for t, r in zip(*linear_assignment(cost)):
+                if cost[t,r] <= max_shift:
+                    track[rows[r]] = t
+                    last[t] = energy[r]
+                    matched[r] = True
+
+        # New tracks for peaks without a match, only the peaks of the first
+        # step with significant peaks get the orbital names
+        first = not last
+        for r in np.flatnonzero(~matched):
+            if first and len(track_names) < len(names):
+                track_names.append(names[len(track_names)])
+            else:
+                track_names.append('peak%i' % len(track_names))
+            track[rows[r]] = len(last)
+            last.append(energy[r])
+
+    return track, track_names
+
+def track_curves(table, track, ntracks, steps):
+    """
+    Returns the energy of every track at every step, NaN where the track
+    has no peak (steps, tracks)
+    """
+    curves = np.full((steps, ntracks), np.nan)
+    rows = track >= 0
+    curves[table['step'][rows], track[rows]] = table['energy'][rows]
+    return curves
+
+def linear_assignment(cost):
+    """
+    Solves the linear assignment problem with the Hungarian method
+
+    Returns the matched rows and columns which minimise the total cost, every
+    row or every column is matched, whichever there are fewer of.
+
+    cost : matrix of costs (rows, columns)
+    """
+    cost = np.asarray(cost, dtype=float)
+    transposed = cost.shape[0] > cost.shape[1]
+    if transposed:
+        cost = cost.T
+    n, m = cost.shape
+
+    # Potentials of the rows and columns, p[j] is the row matched to column j,
+    # index 0 is a dummy column
+    u = np.zeros(n+1)
+    v = np.zeros(m+1)
+    p = np.zeros(m+1, dtype=int)
+    way = np.zeros(m+1, dtype=int)
+    for i in range(1, n+1):
+        p[0] = i
+        j0 = 0
+        minv = np.full(m+1, np.inf)
+        used = np.zeros(m+1, dtype=bool)
+        while True:
+            used[j0] = True
+            i0 = p[j0]
+            reduced = cost[i0-1] - u[i0] - v[1:]
+            better = ~used[1:] & (reduced < minv[1:])
+            minv[1:][better] = reduced[better]
+            way[1:][better] = j0
+            free = np.flatnonzero(~used[1:]) + 1
+            j1 = free[np.argmin(minv[free])]
+            delta = minv[j1]
+            u[p[used]] += delta
+            v[used] -= delta
+            minv[~used] -= delta
+            j0 = j1
+            if p[j0] == 0:
+                break
+        while j0:
+            j1 = way[j0]
+            p[j0] = p[j1]
+            j0 = j1
+
+    cols = np.flatnonzero(p[1:])
+    rows = p[cols+1] - 1
+    order = np.argsort(rows)
+    rows, cols = rows[order], cols[order]
+    if transposed:
+        rows, cols = cols, rows
+        order = np.argsort(rows)
+        rows, cols = rows[order], cols[order]
+    return rows, cols
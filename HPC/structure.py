@@ -0,0 +1,145 @@
+import os
+import functools
+import numpy as np
+
+class Structure:
+    """
+    Contents of a POSCAR or CONTCAR file. The arrays are shared between all
+    callers reading the same file and cannot be changed.
+
+    comment : first line of the file
+    species : element names in the order of the file
+    counts : number of atoms of every element
+    lattice : unitcell vectors as rows, scaled (3, 3)
+    direct : fractional coordinates (atoms, 3)
+    positions : cartesian coordinates (atoms, 3)
+    selective : selective dynamics flags (atoms, 3), None without them
+    velocities : cartesian velocities in Angstrom/fs (atoms, 3), None when
+                 the file has none
+    """
+    def __init__(self, comment, species, counts, lattice, direct, positions,
+                 selective=None, velocities=None):
+        self.comment = comment
+        self.species = species
+        self.counts = counts
+        self.lattice = lattice
+        self.direct = direct
+        self.positions = positions
+        self.selective = selective
+        self.velocities = velocities
+
+    @property
+    def natoms(self):
+        return int(self.counts.sum())
+
+    @property
+    def symbols(self):
+        """
+        Element name of every atom
+        """
+        return [s for s, n in zip(self.species, self.counts) for _ in range(n)]
+
+    @property
+    def codes(self):
+        """
+        Element of every atom as an index into species
+        """
+        return np.repeat(np.arange(len(self.species)), self.counts)
+
+    def index(self, element):
+        """
+        Returns the index of the first atom of an element
+        """
+        if element not in self.species:
+            raise Exception('No %s in structure %s' % (element, self.comment))
+        return int(self.counts[:self.species.index(element)].sum())
+
+    def to_atoms(self):
+        """
+        Returns the structure as an ase Atoms object, without constraints
+        """
+        from ase import Atoms
+        from ase.units import Ang, fs
+        atoms = Atoms(self.symbols, positions=self.positions,
+                      cell=self.lattice, pbc=True)
+        if self.velocities is not None:
+            atoms.set_velocities(self.velocities * (Ang / fs))
+        return atoms
+
+def read_structure(filename):
+    """
+    Reads a POSCAR or CONTCAR file in the VASP 5 format, with element names
+
+    Files are parsed once, later calls return the same Structure until the
+    file is changed.
+    """
+    stat = os.stat(filename)
+    return _read_structure(os.path.abspath(filename), stat.st_mtime_ns,
+                           stat.st_size)
+
+@functools.lru_cache(maxsize=64)
+def _read_structure(filename, mtime, size):
+    with open(filename) as f:
+        lines = f.readlines()
+
+    # name of the system, scaling factor and unitcell matrix, a negative
+    # scaling factor is the volume of the cell
+    comment = lines[0].strip()
+    scaling = float(lines[1].split()[0])
+    lattice = np.array([l.split()[:3] for l in lines[2:5]], dtype=float)
+    if scaling < 0:
+        scaling = (-scaling / abs(np.linalg.det(lattice))) ** (1/3)
+    lattice *= scaling
+
+    # element names and their occurances, followed by the optional selective
+    # dynamics line and the coordinates line
+    species = lines[5].split()
+    if not species or species[0].isdigit():
+        raise Exception('No element names in %s' % filename)
+    counts = np.array(lines[6].split(), dtype=int)
+    natoms = counts.sum()
+    first = 8
+    selective = lines[7].strip()[:1] in ('s', 'S')
+    if selective:
+        first = 9
+    cartesian = lines[first-1].strip()[:1] in ('c', 'C', 'k', 'K')
+
+    rows = [l.split() for l in lines[first:first+natoms]]
+    if len(rows) != natoms:
+        raise Exception('%s has %i of %i atoms' % (filename, len(rows), natoms))
+    coordinates = np.array([r[:3] for r in rows], dtype=float)
+    if cartesian:
+        positions = coordinates * scaling
+        direct = np.linalg.solve(lattice.T, positions.T).T
+    else:
+        direct = coordinates
+        positions = direct @ lattice
+
+    flags = None
+    if selective:
+        flags = np.array([r[3:6] for r in rows]) == 'T'
+
+    # optional velocities after a blank or coordinates line, which VASP
+    # writes to the CONTCAR
+    velocities = None
+    header = first + natoms
+    rows = [l.split() for l in lines[header+1:header+1+natoms]]
+    if len(rows) == natoms and all(len(r) >= 3 for r in rows):
+        velocities = np.array([r[:3] for r in rows], dtype=float)
+        if lines[header].strip()[:1] in ('d', 'D'):
+            velocities = velocities @ lattice
+
+    for a in [counts, lattice, direct, positions, flags, velocities]:
+        if a is not None:
+            a.setflags(write=False)
+    return Structure(comment, species, counts, lattice, direct, positions,
+                     flags, velocities)
+
+def available_cpus():
+    """
+    Returns the number of cores this process may run on, all cores of the
+    machine where the affinity cannot be read
+    """
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count()
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The HPC scripts are plain modules in the folder above
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,39 @@
+import os
+from chain import plan_chain, write_seeds, read_seeds, submit_chain
+
+def test_plan_chain_stride_1():
+    assert plan_chain(5) == {1: None, 2: 1, 3: 2, 4: 3, 5: 4}
+
+def test_plan_chain_stride():
+    assert plan_chain(8, stride=3) == {1: None, 2: 1, 3: 1, 4: None, 5: 4,
+                                       6: 4, 7: None, 8: 7}
+
+def test_seeds_round_trip(tmp_path):
+    for n in range(1, 5):
+        os.mkdir(tmp_path / str(n))
+    plan = plan_chain(4, stride=2)
+    write_seeds(str(tmp_path), plan)
+    assert read_seeds(str(tmp_path), 4) == plan
+
+    # Steps starting from scratch lose their seed file
+    write_seeds(str(tmp_path), dict((n, None) for n in range(1, 5)))
+    assert not any(os.path.exists(tmp_path / str(n) / 'seed')
+                   for n in range(1, 5))
+
+def test_submit_chain_dry_run(capsys):
+    jobs = submit_chain(plan_chain(5, stride=2), script='run',
+                        sbatch='sbatch', dry_run=True)
+    commands = capsys.readouterr().out.splitlines()
+    assert commands == [
+        'sbatch --parsable --array=1,3,5 run',
+        'sbatch --parsable --array=2 --dependency=afterok:1_1 run',
+        'sbatch --parsable --array=4 --dependency=afterok:1_3 run',
+        ]
+    assert jobs == {1: '1_1', 3: '1_3', 5: '1_5', 2: '2', 4: '3'}
+
+def test_submit_chain_stride_1_waits_for_previous(capsys):
+    jobs = submit_chain(plan_chain(3), dry_run=True)
+    commands = capsys.readouterr().out.splitlines()
+    assert commands[1].endswith('--dependency=afterok:1_1 run')
+    assert commands[2].endswith('--dependency=afterok:2 run')
+    assert jobs[3] == '3'
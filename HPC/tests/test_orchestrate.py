@@ -0,0 +1,192 @@
+import os
+import sys
+import shutil
+import subprocess
+import pytest
+from orchestrate import parse_steps, format_steps, submit, run_steps, \
+                        retry_steps, read_state, write_state
+
+HPC = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Stand-in for run: a step fails once if its folder holds a file fail, and
+# gets no LOBSTER output once if it holds a file fail_lobster
+STUB = """#!/bin/bash
+folder=$STUB_OUTPUT/$SLURM_ARRAY_TASK_ID
+echo "start $SLURM_ARRAY_TASK_ID $SKIP_VASP" >> $STUB_OUTPUT/log
+sleep 0.2
+if [ -f $folder/fail ]; then
+    rm $folder/fail
+elif [ -f $folder/fail_lobster ]; then
+    rm $folder/fail_lobster
+    echo "General timing and accounting" > $folder/OUTCAR
+else
+    echo "General timing and accounting" > $folder/OUTCAR
+    echo x > $folder/DOSCAR.lobster
+    echo x > $folder/COHPCAR.lobster
+fi
+echo "end $SLURM_ARRAY_TASK_ID" >> $STUB_OUTPUT/log
+"""
+
+@pytest.fixture
+def output(tmp_path, monkeypatch):
+    """
+    Output folder with four steps, each with a POSCAR
+    """
+    for n in range(1, 5):
+        os.mkdir(tmp_path / str(n))
+        (tmp_path / str(n) / 'POSCAR').write_text('')
+    (tmp_path / 'stub').write_text(STUB)
+    monkeypatch.setenv('STUB_OUTPUT', str(tmp_path))
+    return tmp_path
+
+def read_log(output):
+    return (output / 'log').read_text().split('\n')[:-1]
+
+@pytest.mark.parametrize('steps', [[1], [1, 2, 3], [1, 3, 4, 5, 9, 10, 11],
+                                   [2, 4, 6]])
+def test_steps_round_trip(steps):
+    assert parse_steps(format_steps(steps)) == steps
+
+def test_format_steps():
+    assert format_steps([5, 1, 2, 3, 9]) == '1-3,5,9'
+    assert parse_steps('7,1-3,2') == [1, 2, 3, 7]
+
+def test_submit_dry_run(output, capsys):
+    submit(str(output), [1, 2, 3, 4, 5], per_job=2, groups=2, ntasks=8,
+           max_retries=3, job_script='run_packed', sbatch='my_sbatch',
+           dry_run=True, script='my_run')
+    commands = capsys.readouterr().out.splitlines()
+    assert commands == [
+        'my_sbatch --parsable --ntasks=8 run_packed --steps %s --groups 2 '
+        '--ntasks 8 --max-retries 3 --script my_run --job-script run_packed '
+        '--sbatch my_sbatch' % steps for steps in ['1-2', '3-4', '5']]
+    # A dry run leaves the states alone
+    assert not os.path.exists(output / '1' / 'state')
+
+def test_submit_local_dry_run(output, capsys):
+    submit(str(output), [1, 2], local=True, dry_run=True)
+    command = capsys.readouterr().out.split()
+    assert command[:3] == [sys.executable,
+                           os.path.join(HPC, 'orchestrate.py'), 'worker']
+    assert '--local' in command
+
+def test_failed_step_is_retried(output):
+    (output / '2' / 'fail').write_text('')
+    run_steps(str(output), [1, 2], str(output / 'stub'), ntasks=4)
+    assert read_state(str(output), 1) == ('lobster_done', 1)
+    assert read_state(str(output), 2) == ('failed', 1)
+    assert retry_steps(str(output), [1, 2], max_retries=2) == [2]
+
+    run_steps(str(output), [2], str(output / 'stub'), ntasks=4)
+    assert read_state(str(output), 2) == ('lobster_done', 2)
+    assert retry_steps(str(output), [1, 2], max_retries=2) == []
+
+def test_no_retries_left(output):
+    write_state(str(output), 3, 'failed', 3)
+    assert retry_steps(str(output), [3], max_retries=2) == []
+    assert retry_steps(str(output), [3], max_retries=3) == [3]
+
+def test_running_steps_are_left_alone(output):
+    write_state(str(output), 1, 'running', 1)
+    assert retry_steps(str(output), [1], max_retries=2) == []
+    assert retry_steps(str(output), [1], 2, requeue_running=True) == [1]
+
+def test_finished_vasp_only_reruns_lobster(output):
+    (output / '1' / 'fail_lobster').write_text('')
+    run_steps(str(output), [1], str(output / 'stub'), ntasks=4)
+    assert read_state(str(output), 1) == ('vasp_done', 1)
+
+    run_steps(str(output), [1], str(output / 'stub'), ntasks=4)
+    assert read_state(str(output), 1) == ('lobster_done', 2)
+    assert read_log(output)[::2] == ['start 1 ', 'start 1 1']
+
+def test_step_waits_for_its_seed(output):
+    # Step 2 starts from step 1, steps 3 and 4 from scratch
+    (output / '2' / 'seed').write_text('1\n')
+    run_steps(str(output), [1, 2, 3, 4], str(output / 'stub'), ntasks=4,
+              groups=2)
+    log = read_log(output)
+    assert log.index('start 2 ') > log.index('end 1')
+    assert all(read_state(str(output), n)[0] == 'lobster_done'
+               for n in range(1, 5))
+
+# Stand-ins for the executables called by run
+MPIRUN = """#!/bin/bash
+shift 2
+exec "$@"
+"""
+
+VASP = """#!/bin/bash
+echo "General timing and accounting" > OUTCAR
+echo "wavefunction of $SLURM_ARRAY_TASK_ID" > WAVECAR
+echo "charge of $SLURM_ARRAY_TASK_ID" > CHGCAR
+"""
+
+LOBSTER = """#!/bin/bash
+cp $STUB_FILES/DOSCAR.lobster $STUB_FILES/COHPCAR.lobster .
+"""
+
+DOSCAR = """      1      1      1      0
+  0.1E+02  0.2E-09  0.2E-09  0.4E-08  0.5E-15
+  1.0E-04
+  CAR
+  LOBSTER
+    5.00000   -5.00000      3     0.00000  1.00000000
+   -5.00000     0.10000     0.10000
+    0.00000     0.20000     0.30000
+    5.00000     0.10000     0.40000
+    5.00000   -5.00000      3     0.00000  1.00000000; Z= 6; 2s
+   -5.00000     0.05000
+    0.00000     0.10000
+    5.00000     0.05000
+"""
+
+COHPCAR = """COHPCAR.lobster from a stand-in
+      1      1      3    -5.00000     5.00000     0.00000
+Average
+   -5.00000     0.10000     0.10000
+    0.00000    -0.20000    -0.10000
+    5.00000     0.10000     0.00000
+"""
+
+def test_run_script_with_stand_ins(tmp_path):
+    # run works relative to its own folder, so it runs on a copy
+    hpc = tmp_path / 'HPC'
+    os.makedirs(hpc / 'data')
+    for name in os.listdir(HPC):
+        if name.endswith('.py') or name == 'run':
+            shutil.copy(os.path.join(HPC, name), hpc)
+    for name in ['INCAR', 'POTCAR', 'KPOINTS', 'lobsterin']:
+        (hpc / 'data' / name).write_text('ISTART = 0\n' if name == 'INCAR'
+                                         else '')
+    (hpc / 'data' / 'param.txt').write_text('0.1\n2\n')
+    for n in [1, 2]:
+        os.makedirs(hpc / 'output' / str(n))
+        (hpc / 'output' / str(n) / 'POSCAR').write_text('')
+    (hpc / 'output' / '2' / 'seed').write_text('1\n')
+
+    stubs = tmp_path / 'stubs'
+    os.mkdir(stubs)
+    for name, text in [('mpirun', MPIRUN), ('vasp', VASP),
+                       ('lobster', LOBSTER), ('DOSCAR.lobster', DOSCAR),
+                       ('COHPCAR.lobster', COHPCAR)]:
+        (stubs / name).write_text(text)
+        os.chmod(stubs / name, 0o755)
+    env = dict(os.environ, MPIRUN=str(stubs / 'mpirun'),
+               VASP=str(stubs / 'vasp'), LOBSTER=str(stubs / 'lobster'),
+               STUB_FILES=str(stubs))
+
+    subprocess.run([sys.executable, str(hpc / 'orchestrate.py'), 'worker',
+                    '--steps', '1-2', '--ntasks', '2', '--local'],
+                   cwd=str(hpc), env=env, check=True)
+
+    output = hpc / 'output'
+    assert [read_state(str(output), n) for n in [1, 2]] == \
+           [('lobster_done', 1), ('lobster_done', 1)]
+    # Step 2 was set up to start from the WAVECAR and CHGCAR of step 1
+    incar = (output / '2' / 'INCAR').read_text()
+    assert 'ISTART = 1' in incar and 'ISTART = 0' not in incar
+    # compact.py replaced the LOBSTER text output
+    for n in [1, 2]:
+        assert os.path.isfile(output / str(n) / 'DOSCAR.lobster.npz')
+        assert not os.path.isfile(output / str(n) / 'DOSCAR.lobster')
@@ -0,0 +1,205 @@
+import os
+import json
+import argparse
+import numpy as np
+from lobster_io import read_doscar, read_cohpcar, lobster_exists, CohpData
+from structure import read_structure
+
+def main():
+
+    parser = argparse.ArgumentParser(
+        description='Packs the output folders of all steps into one store')
+    parser.add_argument('--output', default=os.path.join(
+        os.path.dirname(__file__), 'output'))
+    parser.add_argument('--store', default=None,
+                        help='store directory, default output/store')
+    args = parser.parse_args()
+
+    params = os.path.join(os.path.dirname(__file__),'data/param.txt')
+    steps = int(np.loadtxt(params, max_rows=2)[1])
+
+    store = args.store or os.path.join(args.output, 'store')
+    ingest(args.output, store, steps)
+
+def ingest(output, store, steps):
+    """
+    Packs DOS, COHP, geometry and distances of all steps into a directory of
+    .npy files shaped steps x energies x channels, which can be memory-mapped
+
+    output : directory containing the folders 1 ... steps
+    store : directory the store is written to
+    steps : number of steps
+    """
+    if not os.path.isdir(store):
+        os.makedirs(store)
+
+    folders = [os.path.join(output, '%i' % (n+1)) for n in range(steps)]
+
+    # The first complete step sets the shapes and channel names
+    first = None
+    for folder in folders:
+        if _complete(folder):
+            first = folder
+            break
+    if first is None:
+        raise Exception('No finished steps found in %s' % output)
+
+    energies, blocks, columns = read_doscar(
+        os.path.join(first, 'DOSCAR.lobster'))
+    cohp = read_cohpcar(os.path.join(first, 'COHPCAR.lobster'))
+    struc = read_structure(os.path.join(first, 'CONTCAR'))
+
+    dos_channels = ['%i:%s' % (i, c) for i in sorted(blocks)
+                    for c in _names(columns[i], blocks[i].shape[1])]
+    nspin, nrints, nedos_cohp = cohp.cohp.shape
+
+    index = {
+        'steps' : steps,
+        'folders' : [os.path.basename(f) for f in folders],
+        'dos_channels' : dos_channels,
+        'dos_atoms' : dict((str(i), blocks[i].shape[1]) for i in sorted(blocks)),
+        'cohp_spins' : nspin,
+        'cohp_interactions' : nrints,
+        'cohp_types' : cohp.types,
+        'cohp_metadata' : cohp.metadata.tolist(),
+        'symbols' : struc.symbols,
+        }
+
+    arrays = {
+        'dos_energies' : _create(store, 'dos_energies', (len(energies),)),
+        'dos' : _create(store, 'dos', (steps, len(energies), len(dos_channels))),
+        'cohp_energies' : _create(store, 'cohp_energies', (nedos_cohp,)),
+        'cohp' : _create(store, 'cohp', (steps, nedos_cohp, 2*nspin*nrints)),
+        'positions' : _create(store, 'positions', (steps, struc.natoms, 3)),
+        'cell' : _create(store, 'cell', (steps, 3, 3)),
+        'distance' : _create(store, 'distance', (steps,)),
+        'valid' : _create(store, 'valid', (steps,), dtype=bool),
+        }
+    arrays['dos_energies'][:] = energies
+    arrays['cohp_energies'][:] = cohp.energies
+
+    for n, folder in enumerate(folders):
+        print(n+1)
+        param = os.path.join(folder, 'param.txt')
+        if os.path.isfile(param):
+            arrays['distance'][n] = np.loadtxt(param)
+        else:
+            arrays['distance'][n] = np.nan
+
+        if not _complete(folder):
+            for name in ['dos', 'cohp', 'positions', 'cell']:
+                arrays[name][n] = np.nan
+            continue
+
+        e, blocks, columns = read_doscar(os.path.join(folder, 'DOSCAR.lobster'))
+        data = read_cohpcar(os.path.join(folder, 'COHPCAR.lobster'))
+        struc = read_structure(os.path.join(folder, 'CONTCAR'))
+
+        if not np.allclose(e, energies) or \
+           not np.allclose(data.energies, cohp.energies):
+            raise Exception('Energy grid of %s differs from %s' % (folder, first))
+
+        arrays['dos'][n] = np.concatenate([blocks[i] for i in sorted(blocks)],
+                                          axis=1)
+        arrays['cohp'][n] = np.stack([data.cohp, data.icohp], axis=2) \
+                              .reshape(-1, nedos_cohp).T
+        arrays['positions'][n] = struc.positions
+        arrays['cell'][n] = struc.lattice
+        arrays['valid'][n] = True
+
+    for a in arrays.values():
+        a.flush()
+
+    with open(os.path.join(store, 'index.json'), 'w') as f:
+        json.dump(index, f, indent=1)
+
+def open_store(store):
+    """
+    Opens a store written by ingest, arrays are memory-mapped on first use
+
+    store : directory of the store
+    """
+    return TrajectoryStore(store)
+
+class TrajectoryStore:
+    """
+    Lazy view on a store written by ingest
+
+    dos : (steps, energies, channels), channels named in dos_channels
+    cohp : (steps, energies, channels), for every spin and interaction a
+           COHP and an iCOHP channel
+    positions, cell : geometry of the CONTCAR of every step
+    distance : values of param.txt of every step
+    valid : steps which were finished when the store was made
+    """
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, 'index.json')) as f:
+            self.index = json.load(f)
+        self._arrays = {}
+
+    def __getattr__(self, name):
+        if name.startswith('_') or name in ('path', 'index') or \
+           not os.path.isfile(os.path.join(self.path, name + '.npy')):
+            raise AttributeError(name)
+        if name not in self._arrays:
+            self._arrays[name] = np.load(os.path.join(self.path, name + '.npy'),
+                                         mmap_mode='r')
+        return self._arrays[name]
+
+    @property
+    def steps(self):
+        return self.index['steps']
+
+    def dos_columns(self, atom):
+        """
+        Returns the slice of the DOS channels belonging to an atom
+        """
+        start = 0
+        for i, n in self.index['dos_atoms'].items():
+            if int(i) == atom:
+                return slice(start, start+n)
+            start += n
+        raise KeyError('Atom %i is not in the store' % atom)
+
+    def frame_dos(self, step, atoms):
+        """
+        Returns energies and the DOS of some atoms of one step like
+        read_doscar does
+
+        step : 0-based step
+        atoms : list of atom indices
+        """
+        blocks = dict((i, np.array(self.dos[step,:,self.dos_columns(i)]))
+                      for i in atoms)
+        return np.array(self.dos_energies), blocks
+
+    def frame_cohp(self, step):
+        """
+        Returns the COHP of one step as a CohpData object
+        """
+        nspin = self.index['cohp_spins']
+        nrints = self.index['cohp_interactions']
+        pairs = np.array(self.cohp[step]).T.reshape(nspin, nrints, 2, -1)
+        return CohpData(np.array(self.cohp_energies),
+                        np.ascontiguousarray(pairs[:,:,0]),
+                        np.ascontiguousarray(pairs[:,:,1]),
+                        self.index['cohp_types'],
+                        np.array(self.index['cohp_metadata']))
+
+def _complete(folder):
+    return all(lobster_exists(os.path.join(folder, f)) for f in
+               ['DOSCAR.lobster', 'COHPCAR.lobster']) and \
+           os.path.isfile(os.path.join(folder, 'CONTCAR'))
+
+def _names(columns, n):
+    if len(columns) == n:
+        return columns
+    return ['%i' % c for c in range(n)]
+
+def _create(store, name, shape, dtype=float):
+    return np.lib.format.open_memmap(os.path.join(store, name + '.npy'),
+                                     mode='w+', dtype=dtype, shape=shape)
+
+if __name__ == '__main__':
+    main()
@@ -1,213 +1,523 @@
-import re
+import io
 import os
+import json
+import hashlib
+import argparse
+import contextlib
+import functools
+import multiprocessing
 import numpy as np
 import matplotlib.pyplot as plt
-import ase.io
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
 from PIL import Image
+from lobster_io import read_doscar, read_cohpcar, lobster_exists, lobster_path
+from trajectory import open_store
+from structure import read_structure, available_cpus
+from peaks import sigma_pi, peak_table, trajectory_peaks, track_peaks, \
+                  track_curves
+
+# Minimum |DOS| of a sigma and a pi peak, and the names given to the
+# tracked peaks in order of energy at the first step
+THRESHOLDS = [0.9,1.2]
+TRACKS = [['3sigma','4sigma','5sigma','6sigma'],
+          ['1pi','2pi']]
+
+# Modules whose code is part of the plots
+MODULES = ['visualise.py', 'peaks.py', 'lobster_io.py', 'structure.py']
+
+# Estimated peak memory in MB of one frame: the 4200x4200 canvas, the saved
+# plot read back by PIL and the 6300x4200 composite, plus the interpreter
+FRAME_MEMORY = 600
 
 def main():
     
+    parser = argparse.ArgumentParser(description='Makes the plots of all steps')
+    parser.add_argument('--store', default=None,
+                        help='read the data from a store made by trajectory.py')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='number of frames rendered in parallel, 0 uses '
+                             'all cores of the node')
+    parser.add_argument('--frame-memory', type=float, default=FRAME_MEMORY,
+                        help='estimated peak memory of one frame in MB, '
+                             'limits the number of workers')
+    parser.add_argument('--frames', default=None,
+                        help='steps to render, e.g. 1-10,15, default all')
+    parser.add_argument('--force', action='store_true',
+                        help='render the frames even if their inputs did not '
+                             'change since the last run')
+    args = parser.parse_args()
+    
     # Setting paths to files
-    poscar = os.path.join(os.path.dirname(__file__),'data/POSCAR')
     params = os.path.join(os.path.dirname(__file__),'data/param.txt')
     
     # Settings for linear translation, 0 is equilibrium position
     param = np.loadtxt(params, max_rows=2)
-    max_distance = param[0]
     steps = int(param[1])
+    frames = parse_frames(args.frames, steps)
+    
+    # Giving every peak the same label along the whole trajectory
+    labels = track_labels(steps, args.store)
+    
+    # Only rendering frames whose inputs or settings changed since the last
+    # run, frames with missing inputs are left for a later run
+    manifest_path = os.path.join(os.path.dirname(__file__), 'output',
+                                 'images', 'manifest.json')
+    manifest = load_manifest(manifest_path)
+    keys = {}
+    todo = []
+    for cnt in frames:
+        key = frame_key(cnt, args.store, labels)
+        image = os.path.join(os.path.dirname(__file__), 'output', 'images',
+                             '%i.png' % cnt)
+        if key is None:
+            print('%i skipped, inputs missing' % cnt)
+        elif args.force or manifest.get(str(cnt)) != key or \
+             not os.path.isfile(image):
+            keys[cnt] = key
+            todo.append(cnt)
+    print('%i of %i frames to render' % (len(todo), len(frames)), flush=True)
+    
+    render = functools.partial(render_frame, store_path=args.store,
+                               labels=labels)
+    workers = min(plan_workers(args.workers, args.frame_memory),
+                  max(len(todo), 1))
+    
+    # Frames are rendered out of order by the workers, imap hands back
+    # their output in frame order
+    if workers > 1:
+        pool = multiprocessing.Pool(workers, maxtasksperchild=20)
+        logs = pool.imap(render, todo)
+    else:
+        pool = None
+        logs = map(render, todo)
+    
+    try:
+        for cnt, log in zip(todo, logs):
+            print(log, end='', flush=True)
+            manifest[str(cnt)] = keys[cnt]
+            save_manifest(manifest_path, manifest)
+    finally:
+        if pool is not None:
+            pool.terminate()
 
-    # Setting distance Rh to C in base structure
-    base_dist = 1.389121355
-      
-
-    # Writing the files
-    cnt = 0
-    for d in np.linspace(0,max_distance,steps,2):
-        cnt += 1
+def parse_frames(text, steps):
+    """
+    Returns the steps selected by a text like 1-10,15, all steps if None
+    """
+    if not text:
+        return list(range(1, steps+1))
+    
+    frames = []
+    for part in text.split(','):
+        if '-' in part:
+            first, last = part.split('-')
+            frames += range(int(first), int(last)+1)
+        else:
+            frames.append(int(part))
+    
+    return sorted(set(f for f in frames if 1 <= f <= steps))
 
+def frame_key(cnt, store_path, labels):
+    """
+    Returns a hash of everything a frame depends on: the modification time
+    and size of its input files, or its data in the store, the peak labels
+    and the plot settings. Returns None if an input is missing.
+    """
+    data = None
+    if store_path:
+        # Only the slices of this step count, so changing other steps in
+        # the store leaves the frame as it is. Steps which were not finished
+        # when the store was made have no data.
+        store = open_store(store_path)
+        if not store.valid[cnt-1]:
+            return None
+        digest = hashlib.sha1(json.dumps(store.index, sort_keys=True).encode())
+        for a in [store.dos_energies, store.cohp_energies, store.dos[cnt-1],
+                  store.cohp[cnt-1], store.positions[cnt-1],
+                  store.distance[cnt-1]]:
+            digest.update(np.ascontiguousarray(a).tobytes())
+        data = digest.hexdigest()
+        inputs = []
+    else:
         tpath = os.path.join(os.path.dirname(__file__), 'output', '%i' % cnt)
-        
-        # Making the plots
-        fig = plt.figure(dpi=600, figsize=[7,7])
-        ax1 = plt.subplot(122)
-        ax2 = plt.subplot(221)
-        ax3 = plt.subplot(223)
-        
-        c_index = atom_index(poscar, 'C') 
-        o_index = atom_index(poscar, 'O') 
-        
-        # Plot DOS
-        e,sigma,pi = read_data_DOS(tpath, c_index, o_index)
-        plot_DOS(ax1, e, sigma, pi)
-        
-        # Find and label peaks DOS
-        # when peaks get to small remove the label from the labels list
-        # and add the labels manually. See example in function plot_peaks
-        
-        idos_list = []
-        peak_points_list = []
-        
-        thresholds = [0.9,1.2]
-        
-        count = 0
-        for m in [sigma, pi]:
-            idos_list.append(integrate_dos(m, e))
-            peak_points_list.append(find_peaks(thresholds[count],m, e))
-            count = count + 1
-        
-        labels = [['$3\sigma$','$4\sigma$','$5\sigma$','$6\sigma$','','','','','',''],
-                  ['$1\pi$','$2\pi$','','','','','','']]
-        
-        dos = [sigma, pi]
-        peak_x_list = []
-        for n in range(2):
-            peak_x, max_index = find_peaks_x(dos[n],idos_list[n],peak_points_list[n])
-            if n == 1:
-                for o in range(len(peak_x)):
-                    peak_x[o] = peak_x[o] + dos[0][max_index[o]] 
-            peak_x_list.append(peak_x)
-            
-        print(cnt)
-        print(peak_x_list)
+        inputs = [lobster_path(os.path.join(tpath, f)) for f in
+                  ['DOSCAR.lobster', 'COHPCAR.lobster', 'CONTCAR', 'param.txt']]
+    inputs.append(os.path.join(os.path.dirname(__file__), 'data', 'POSCAR'))
+    
+    # The plotting code itself is a setting as well
+    for module in MODULES:
+        inputs.append(os.path.join(os.path.dirname(__file__), module))
+    
+    state = [file_state(path) for path in inputs]
+    if None in state:
+        return None
+    
+    settings = {
+        'inputs' : state,
+        'data' : data,
+        'thresholds' : THRESHOLDS,
+        'labels' : labels[cnt] if labels is not None else None,
+        }
+    
+    return hashlib.sha1(json.dumps(settings).encode()).hexdigest()
 
-        
-        for p in range(2):
-            plot_peaks(idos_list[p], ax1, peak_points_list[p], e, 12, labels[p], peak_x_list[p])
-     
-        
-        # Plot COHPs
-        data, types, metadata = read_data_COHP(tpath)
-        plot_COHP_total(ax2, data, types, metadata)
-        plot_COHP_orbital(ax3, data, types, metadata)
-        
-        fig.tight_layout()
+def file_state(path):
+    """
+    Returns the name, modification time and size of a file, None if it is
+    missing
+    """
+    if not os.path.isfile(path):
+        return None
+    stat = os.stat(path)
+    return [os.path.basename(path), stat.st_mtime_ns, stat.st_size]
 
-        # Saving just the plots
-        plt.savefig(os.path.join(tpath, '%i.png' %cnt))
-        
-        # Finding distances from CONTCAR and adding to plot
-        distance = np.loadtxt(os.path.join(tpath, 'param.txt')) + base_dist
-        co_dist = find_bondlength(tpath)
-        
-        # Making images of the distances
-        distance = format(distance, '.2f')
-        co_dist = format(co_dist, '.2f')
-        latex_image(r'|\vec{r}_{Rh-C}|=',distance,'Rh-C')   
-        latex_image(r'|\vec{r}_{C-O}|=',co_dist,'C-O') 
-        
-        # Adding distances to image
-        plot_image = Image.open(os.path.join(tpath, '%i.png' %cnt))
-        img = add_distances(plot_image)
-        
-        # Saving image and closing off
-        img.save(os.path.join(os.path.dirname(__file__),'output','images',
-                              '%i.png' %cnt))
-        plt.close('all')
-        
-        
-def atom_index(poscar,atom_name):
+def tracks_key(steps, store_path=None):
+    """
+    Returns a hash of everything the peak tracks depend on: the
+    modification time and size of the DOSCAR.lobster and param.txt of every
+    step, or of the store, the reference POSCAR, the thresholds, the track
+    names and the code
+    """
+    folder = os.path.dirname(__file__)
+    if store_path:
+        inputs = [os.path.join(store_path, name) for name in
+                  ['index.json', 'dos_energies.npy', 'dos.npy', 'distance.npy',
+                   'valid.npy']]
+    else:
+        inputs = []
+        for n in range(steps):
+            tpath = os.path.join(folder, 'output', '%i' % (n+1))
+            inputs += [lobster_path(os.path.join(tpath, 'DOSCAR.lobster')),
+                       os.path.join(tpath, 'param.txt')]
+    inputs.append(os.path.join(folder, 'data', 'POSCAR'))
+    inputs += [os.path.join(folder, module) for module in MODULES]
+    
+    settings = {
+        'steps' : steps,
+        'store' : bool(store_path),
+        'inputs' : [file_state(path) for path in inputs],
+        'thresholds' : THRESHOLDS,
+        'tracks' : TRACKS,
+        }
+    return hashlib.sha1(json.dumps(settings).encode()).hexdigest()
+
+def load_manifest(path):
+    """
+    Returns the keys of the frames rendered before
+    """
+    if not os.path.isfile(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+def save_manifest(path, manifest):
+    temp = path + '.tmp'
+    with open(temp, 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(temp, path)
+
+def render_frame(cnt, store_path=None, labels=None):
     """
-    Finds the index of an atom based on the poscar
+    Makes the plot image of one step and returns what was printed
     
-    poscar : POSCAR file
-    atom_name : string with a atom to find
+    cnt : number of the step, 1 ... steps
+    store_path : trajectory store to read from instead of the output folder
+    labels : labels of the sigma and pi peaks of every step made by
+             track_labels, the peaks are labelled in order of energy if None
     """
+    log = io.StringIO()
+    with contextlib.redirect_stdout(log):
+        _render_frame(cnt, store_path, labels)
+    return log.getvalue()
 
-    atoms = np.loadtxt(poscar,dtype=str, skiprows=5, max_rows=1)
-    nr_atoms = np.loadtxt(poscar, skiprows=6, max_rows=1)
+def _render_frame(cnt, store_path, labels):
     
-    i_count = 0
+    # Setting paths to files
+    poscar = os.path.join(os.path.dirname(__file__),'data/POSCAR')
     
-    for i in atoms:
-        if i == atom_name:
-            ind_atom = i_count
-        else:
-            i_count += 1
+    store = None
+    if store_path:
+        store = open_store(store_path)
+        if not store.valid[cnt-1]:
+            raise Exception('Step %i is not in the store %s' % (cnt, store_path))
+
+    # Setting distance Rh to C in base structure
+    base_dist = 1.389121355
+
+    tpath = os.path.join(os.path.dirname(__file__), 'output', '%i' % cnt)
+    
+    structure = read_structure(poscar)
+    c_index = structure.index('C')
+    o_index = structure.index('O')
+    
+    # Plot DOS and COHPs, the figure is made once per process and only gets
+    # new data every frame
+    e,sigma,pi = read_data_DOS(tpath, c_index, o_index, store, cnt-1)
+    cohp = read_data_COHP(tpath, store, cnt-1)
+    renderer = frame_renderer(e, cohp)
+    renderer.draw(e, sigma, pi, cohp)
     
-    index_atom = 0
+    # Find and label peaks DOS
+    tables = [peak_table(sigma, e, THRESHOLDS[0]),
+              peak_table(pi, e, THRESHOLDS[1], offset=sigma)]
     
-    for j in range(0,ind_atom):
-        index_atom = index_atom + nr_atoms[j]
+    if labels is not None:
+        frame_labels = labels[cnt]
+    else:
+        frame_labels = [[latex_label(n) for n in names] + ['']*len(t['x'])
+                        for names, t in zip(TRACKS, tables)]
         
+    print(cnt)
+    print([list(t['x'][t['significant']]) for t in tables])
     
-    return int(index_atom)
+    for p in range(2):
+        plot_peaks(renderer.ax1, tables[p], frame_labels[p])
 
-def read_data_DOS(folder,c_index,o_index):
+    # Saving just the plots
+    renderer.save(os.path.join(tpath, '%i.png' %cnt))
+    
+    # Finding distances from CONTCAR and adding to plot
+    if store is not None:
+        distance = store.distance[cnt-1] + base_dist
+    else:
+        distance = np.loadtxt(os.path.join(tpath, 'param.txt')) + base_dist
+    co_dist = find_bondlength(tpath, store, cnt-1)
+    
+    # Making images of the distances
+    distance = format(distance, '.2f')
+    co_dist = format(co_dist, '.2f')
+    rh_c = latex_image(r'|\vec{r}_{Rh-C}|=',distance)   
+    c_o = latex_image(r'|\vec{r}_{C-O}|=',co_dist) 
+    
+    # Adding distances to image
+    plot_image = Image.open(os.path.join(tpath, '%i.png' %cnt))
+    img = add_distances(plot_image, rh_c, c_o)
+    
+    # Saving image and closing off
+    img.save(os.path.join(os.path.dirname(__file__),'output','images',
+                          '%i.png' %cnt))
+
+class FrameRenderer:
     """
-    Returns the extracted data of DOS
+    Figure with the DOS and the two COHP panels. The axes, grids, legends
+    and limits are made once, every frame only the curves and the peak
+    labels are replaced and the layout is redone.
     
-    folder : folder which contains a DOSCAR.lobster file
+    e : energies of the DOS
+    cohp : CohpData of a step, sets the energies of the COHP panels
+    """
+    def __init__(self, e, cohp):
+        self.fig = plt.figure(dpi=600, figsize=[7,7])
+        self.ax1 = self.fig.add_subplot(122)
+        self.ax2 = self.fig.add_subplot(221)
+        self.ax3 = self.fig.add_subplot(223)
+        
+        zeros = np.zeros_like(e)
+        self.dos = plot_DOS(self.ax1, e, zeros, zeros)
+        self.cohp_total = plot_COHP_total(self.ax2, cohp)
+        self.cohp_orbital = plot_COHP_orbital(self.ax3, cohp)
+    
+    def draw(self, e, sigma, pi, cohp):
+        """
+        Puts the data of a step in the figure and removes the peak labels
+        of the previous step
+        """
+        for text in list(self.ax1.texts):
+            text.remove()
+        
+        update_DOS(self.dos, e, sigma, pi)
+        update_COHP_total(self.cohp_total, cohp)
+        update_COHP_orbital(self.cohp_orbital, cohp)
+    
+    def save(self, filename):
+        # The layout depends on the peak labels of the step, so it is made
+        # after they are placed, as when the figure was built per frame.
+        # tight_layout starts from the current subplot parameters, which are
+        # reset first so the layout does not depend on the previous frames.
+        self.fig.subplots_adjust(**dict(
+            (k, plt.rcParams['figure.subplot.' + k])
+            for k in ['left', 'bottom', 'right', 'top', 'wspace', 'hspace']))
+        self.fig.tight_layout()
+        self.fig.savefig(filename)
+
+_renderer = None
+
+def frame_renderer(e, cohp):
+    """
+    Returns the FrameRenderer of this process, made on first use
+    """
+    global _renderer
+    if _renderer is None:
+        _renderer = FrameRenderer(e, cohp)
+    return _renderer
+
+def track_labels(steps, store_path=None):
     """
-    skip_c = 908 + c_index*902
-    skip_o = 908 + o_index*902
-    data_c = np.loadtxt(os.path.join(folder, 'DOSCAR.lobster'),
-                        skiprows=skip_c, max_rows=901)
-    data_o = np.loadtxt(os.path.join(folder, 'DOSCAR.lobster'),
-                        skiprows=skip_o, max_rows=901)
+    Tracks the sigma and pi peaks over all steps, writes the energy of every
+    tracked peak against the distance to output/peak_tracks.csv and returns
+    the labels of the peaks of every step
     
-    e = data_c[:,0]
-    s = data_c[:,1] + data_o[:,1]
-    py = data_c[:,2] + data_o[:,2]
-    pz = data_c[:,3] + data_o[:,3]
-    px = data_c[:,4] + data_o[:,4]
+    The labels are kept in output/images/tracks.json and only made again
+    when tracks_key changes, e.g. when a step has finished.
     
-    sigma = s + pz
-    pi = px + py
+    steps : number of steps
+    store_path : trajectory store to read from instead of the output folders
+    """
+    output = os.path.join(os.path.dirname(__file__), 'output')
+    cache = os.path.join(output, 'images', 'tracks.json')
+    key = tracks_key(steps, store_path)
+    if os.path.isfile(cache) and \
+       os.path.isfile(os.path.join(output, 'peak_tracks.csv')):
+        with open(cache) as f:
+            cached = json.load(f)
+        if cached['key'] == key:
+            return _int_keys(cached['labels'])
+    
+    labels = _track_labels(steps, store_path)
+    if not os.path.isdir(os.path.dirname(cache)):
+        os.makedirs(os.path.dirname(cache))
+    with open(cache, 'w') as f:
+        json.dump({'key' : key, 'labels' : labels}, f)
+    return labels
+
+def _int_keys(labels):
+    if labels is None:
+        return None
+    return dict((int(n), l) for n, l in labels.items())
+
+def _track_labels(steps, store_path):
     
-    return e,sigma,pi
+    poscar = os.path.join(os.path.dirname(__file__),'data/POSCAR')
+    structure = read_structure(poscar)
+    c_index = structure.index('C')
+    o_index = structure.index('O')
+    
+    if store_path:
+        store = open_store(store_path)
+        tables = trajectory_peaks(store, c_index, o_index, THRESHOLDS)
+        distances = np.array(store.distance)
+    else:
+        # Steps which have not finished yet are left empty
+        sigma = None
+        distances = np.full(steps, np.nan)
+        for n in range(steps):
+            tpath = os.path.join(os.path.dirname(__file__), 'output', '%i' % (n+1))
+            if not lobster_exists(os.path.join(tpath, 'DOSCAR.lobster')):
+                continue
+            e, s, p = read_data_DOS(tpath, c_index, o_index)
+            if sigma is None:
+                sigma = np.full((steps, len(e)), np.nan)
+                pi = np.full((steps, len(e)), np.nan)
+            sigma[n] = s
+            pi[n] = p
+            distances[n] = np.loadtxt(os.path.join(tpath, 'param.txt'))
+        if sigma is None:
+            return None
+        tables = [peak_table(sigma, e, THRESHOLDS[0]),
+                  peak_table(pi, e, THRESHOLDS[1], offset=sigma)]
+    
+    labels = dict((n+1, [[], []]) for n in range(steps))
+    columns = []
+    curves = []
+    for p in range(2):
+        track, names = track_peaks(tables[p], TRACKS[p])
+        for step, t in zip(tables[p]['step'], track):
+            if t >= 0:
+                labels[step+1][p].append(latex_label(names[t]))
+            else:
+                labels[step+1][p].append('')
+        columns += names
+        curves.append(track_curves(tables[p], track, len(names), steps))
+    
+    np.savetxt(os.path.join(os.path.dirname(__file__), 'output', 'peak_tracks.csv'),
+               np.column_stack([np.arange(1, steps+1), distances] + curves),
+               delimiter=',', fmt='%.6g',
+               header=','.join(['step', 'distance'] + columns))
+    
+    return labels
 
+def latex_label(name):
+    """
+    Returns the label of a tracked peak, peaks without an orbital name get
+    no label
+    """
+    for orbital in ['sigma', 'pi']:
+        if name.endswith(orbital) and name[:-len(orbital)].isdigit():
+            return '$%s\\%s$' % (name[:-len(orbital)], orbital)
+    return ''
 
-def read_data_COHP(folder):
+def plan_workers(requested, frame_memory):
     """
-    Returns extracted data of COHP
+    Returns the number of workers that fits in the cores and the memory of
+    the node
     
-    folder : folder containing COHP.lobster file
+    requested : wanted number of workers, 0 uses all cores
+    frame_memory : estimated peak memory of one frame in MB
     """
-    filename = os.path.join(folder,'COHPCAR.lobster')
+    cores = available_cpus()
+    if 'SLURM_CPUS_ON_NODE' in os.environ:
+        cores = min(cores, int(os.environ['SLURM_CPUS_ON_NODE']))
     
-    f = open(filename)
-    f.readline()                          # skip first line
-    nrints = int(f.readline().split()[0]) # read nr of interactions
-    f.readline()                          # skip another line
+    if requested <= 0:
+        requested = cores
+    workers = min(requested, cores)
+    
+    memory = available_memory()
+    if memory is not None:
+        workers = min(workers, int(memory // frame_memory))
+    
+    return max(workers, 1)
 
-    # loop over interactions and collect the types
-    types = []
-    for i in range(1, nrints):
-        line = f.readline()
-        m = re.match(r'No.([0-9]+):([A-Za-z]{1,2})([0-9]+)\[([0-9][spdf]_?[a-z^2-]*)\]->([A-Za-z]{1,2})([0-9]+)\[([0-9][spdf]_?[a-z-^2]*)\].*', line)
+def available_memory():
+    """
+    Returns the memory in MB available to this job, None if unknown
+    """
+    memory = None
+    if os.path.isfile('/proc/meminfo'):
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    memory = int(line.split()[1]) / 1024
+    
+    # The allocation of the job can be smaller than the free memory
+    if 'SLURM_MEM_PER_NODE' in os.environ:
+        slurm = float(os.environ['SLURM_MEM_PER_NODE'])
+        if memory is None or slurm < memory:
+            memory = slurm
+    
+    return memory
         
-        if m:
-            types.append({
-                'type' : 'orbitalwise',
-                'interaction_id' : int(m.group(1)),
-                'element1' : m.group(2),
-                'atomid1' : int(m.group(3)),
-                'orbital1' : m.group(4),
-                'element2' : m.group(5),
-                'atomid2' : int(m.group(6)),
-                'orbital2' : m.group(7),
-            })
-        else:
-            m = re.match(r'No.([0-9]+):([A-Za-z]{1,2})([0-9]+)->([A-Za-z]{1,2})([0-9]+).*', line)
-            if m:
-                types.append({
-                    'type' : 'total',
-                    'interaction_id' : int(m.group(1)),
-                    'element1' : m.group(2),
-                    'atomid1' : int(m.group(3)),
-                    'element2' : m.group(4),
-                    'atomid2' : int(m.group(5)),
-                })
-            else:
-                raise Exception('Cannot parse line: %s' % line)
-    f.close()
+        
+def read_data_DOS(folder,c_index,o_index,store=None,step=None):
+    """
+    Returns the extracted data of DOS
+    
+    folder : folder which contains a DOSCAR.lobster file
+    store : trajectory store to read from instead of the folder
+    step : 0-based step in the store
+    """
+    if store is not None:
+        e, blocks = store.frame_dos(step, [c_index, o_index])
+    else:
+        e, blocks, columns = read_doscar(
+            os.path.join(folder, 'DOSCAR.lobster'), [c_index, o_index])
+    sigma, pi = sigma_pi(blocks[c_index], blocks[o_index])
     
-    metadata = np.loadtxt(filename, skiprows=1, max_rows=1)
+    return e,sigma,pi
+
 
-    # read all the data
-    data = np.loadtxt(filename, skiprows=nrints+2)
+def read_data_COHP(folder,store=None,step=None):
+    """
+    Returns extracted data of COHP as a CohpData object
     
-    return data, types, metadata
+    folder : folder containing COHP.lobster file
+    store : trajectory store to read from instead of the folder
+    step : 0-based step in the store
+    """
+    if store is not None:
+        return store.frame_cohp(step)
+    return read_cohpcar(os.path.join(folder,'COHPCAR.lobster'))
 
 def plot_DOS(ax,e,sigma,pi, title=None, 
              colors=['#fe6100','#648fff']):
@@ -218,10 +528,12 @@ def plot_DOS(ax,e,sigma,pi, title=None,
     bottom = np.zeros_like(sigma)
     top = np.zeros_like(sigma)
     
+    artists = []
     for l,c,label in zip([sigma,pi], colors, labels):
         top = np.add(top,l)
-        ax.fill_betweenx(e, bottom, top, color=c, label=label, alpha=0.8)
-        ax.plot(top, e, linewidth=0.9, color=c)
+        fill = ax.fill_betweenx(e, bottom, top, color=c, label=label, alpha=0.8)
+        line, = ax.plot(top, e, linewidth=0.9, color=c)
+        artists.append((fill, line))
         bottom = np.add(bottom,l)
     
     ax.grid(linestyle='--', alpha=0.5, zorder=-1)
@@ -233,105 +545,51 @@ def plot_DOS(ax,e,sigma,pi, title=None,
     
     if title:
         ax.set_title(title)
+    
+    return artists
 
-def find_peaks(threshold, dos, energies_dft_zero):
-    """
-    finds the peaks, at what y (energy) they are
-    """
-    # find peak areas
-    dos = abs(dos) 
-
-    # find start and end points of peaks
-    dos_bin = [1 if x>=threshold else 0 for x in dos]
-    peak_points = []
-    for i in range(len(dos_bin)-1):
-        if dos_bin[i] == 0 and dos_bin[i+1] == 1:
-            peak_points.append(i+1)
-        if dos_bin[i] == 1 and dos_bin[i+1] == 0:
-            peak_points.append(i)
-    return peak_points
-
-def find_peaks_x(dos,idos,peak_points):
+def update_DOS(artists, e, sigma, pi):
     """
-    find at what value of x (pDOS) the peaks are
+    Replaces the data of the artists made by plot_DOS
     """
-    count = 0
-    peak_x = []
-    max_index = []
-    for i in range(int(len(peak_points)/2.0)):
-        index1 = peak_points[count]
-        index2 = peak_points[count+1]
-        delta_peak = idos[index2]-idos[index1]
-        if abs(delta_peak) > 0.00001:
-            label_loc = max(dos[index1:index2])
-            peak_x.append(label_loc+0.1)
-            max_index.append(np.where(dos == label_loc)[0][0])
-
-        count = count + 2
-    return peak_x, max_index
+    bottom = np.zeros_like(sigma)
+    top = np.zeros_like(sigma)
     
-def plot_peaks(idos, ax, peak_points, energies_dft_zero, xlim, labels, peak_x):
+    for l,(fill,line) in zip([sigma,pi], artists):
+        top = np.add(top,l)
+        fill.set_verts([np.concatenate([np.column_stack([bottom, e]),
+                                        np.column_stack([top, e])[::-1]])])
+        line.set_data(top, e)
+        bottom = np.add(bottom,l)
+
+def plot_peaks(ax, table, labels, lim_plot=11):
     """
     plots the peak labels
-    """
-    lim_plot = 11
-    count = 0
-    for i in range(int(len(peak_points)/2.0)):
-        index1 = peak_points[count]
-        index2 = peak_points[count+1]
-        delta_peak = idos[index2]-idos[index1]
-        
-        if int(len(peak_points)/2.0) > len(peak_x):
-            peak_x.append(0)
-        
-        if abs(delta_peak) > 0.00001:
-            if peak_x[i] < lim_plot:
-              height = energies_dft_zero[index1]+abs((energies_dft_zero[index1]-energies_dft_zero[index2])/2.0)-0.5
-              ax.text(peak_x[i], height, labels[i], color='black', size=11)
-              print(height)
-            elif peak_x[i] >= lim_plot:
-              peak_x[i] = lim_plot
-              height = energies_dft_zero[index1]+abs((energies_dft_zero[index1]-energies_dft_zero[index2])/2.0)-0.5
-              ax.text(peak_x[i], height, labels[i], color='black', size=11)
-              print(height)
-        count = count + 2
-
-        # Add label for 6sigma manually
-        #ax.text(1.8, 5.5, '$6\sigma$', color='black', size=11)
-        
     
-def integrate_dos(dos, energies_dft_zero):
+    table : peak table of one step made by peaks.peak_table
+    labels : label of every peak in the table
+    lim_plot : labels further right than this are moved to it
     """
-    integrated the dos
-    """
-    idos = np.zeros_like(energies_dft_zero)
-    dx = (abs(energies_dft_zero[0]) + abs(energies_dft_zero[-1])) / float(len(energies_dft_zero))
-    for i in range(len(dos)):
-        idos[i] = idos[i-1] + dos[i] * dx  
-    return idos
+    for i in np.flatnonzero(table['significant']):
+        x = min(table['x'][i], lim_plot)
+        height = table['height'][i]
+        ax.text(x, height, labels[i], color='black', size=11)
+        print(height)
 
-def plot_COHP_total(ax, data, types, metadata, title=None,
+def plot_COHP_total(ax, data, title=None,
               colors=['#785EF0','#000000']):
     """
     Plots total COHP
     """    
-    spinpol = int(metadata[1])-1
-    nrints = int(metadata[0])
-    
-    energies = data[:,0]
-    energies_dft_zero = energies
-    if spinpol:
-        cohp = data[:,3] + data[:,3+2*nrints]
-        icohp = data[:,4] + data[:,4+2*nrints]
-    else:
-        cohp = data[:,3]
-        icohp = data[:,4]
+    energies_dft_zero = data.energies
+    cohp, icohp = data.total(1)
 
     xlim = 40 
-    ax.fill(cohp, energies_dft_zero, alpha=0.8, color=colors[0], label='COHP')
-    ax.plot(cohp, energies_dft_zero, color=colors[0], linewidth=0.7)
-    ax.plot(icohp, energies_dft_zero, linestyle='--', linewidth=1.0, alpha=0.8,
-            color=colors[1], label='iCOHP')
+    fill, = ax.fill(cohp, energies_dft_zero, alpha=0.8, color=colors[0],
+                    label='COHP')
+    line, = ax.plot(cohp, energies_dft_zero, color=colors[0], linewidth=0.7)
+    iline, = ax.plot(icohp, energies_dft_zero, linestyle='--', linewidth=1.0,
+                     alpha=0.8, color=colors[1], label='iCOHP')
     ax.set_ylim(-30,10)
     ax.set_xlim(-xlim,xlim)
     ax.legend(loc='lower right')
@@ -342,46 +600,40 @@ def plot_COHP_total(ax, data, types, metadata, title=None,
     
     if title:
         ax.set_title(title)
+    
+    return fill, line, iline
+
+def update_COHP_total(artists, data):
+    """
+    Replaces the data of the artists made by plot_COHP_total
+    """
+    fill, line, iline = artists
+    cohp, icohp = data.total(1)
+    
+    fill.set_xy(np.column_stack([cohp, data.energies]))
+    line.set_data(cohp, data.energies)
+    iline.set_data(icohp, data.energies)
         
-def plot_COHP_orbital(ax, data, types, metadata, title=None,
+def plot_COHP_orbital(ax, data, title=None,
               colors=['#fe6100','#648fff']):
     """
     Plots COHP orbitals wise
     """    
-    spinpol = int(metadata[1])-1
-    nrints = int(metadata[0])
-    
-    energies = data[:,0]
-    energies_dft_zero = energies
-    pools = [np.zeros_like(energies) for j in range(0,16)]
-    orbitalpools = ['ss', 'sp_z', 'p_zs', 'p_zp_z', 'p_xp_x', 'p_xp_y', 'p_yp_x', 'p_yp_y',
-                    'sp_x', 'p_xs', 'sp_y', 'p_ys', 'p_xp_z', 'p_zp_x', 'p_yp_z', 'p_zp_y']
-    for i,datatype in enumerate(types):
-        j = 1+(2*(i+1))
-        k = 1+(2*(i+1))+(2*(nrints))
-        if datatype['type'] == 'orbitalwise':
-            intlabel = datatype['orbital1'][1:] + datatype['orbital2'][1:]
-            poolid = orbitalpools.index(intlabel)
-            if spinpol:
-                pools[poolid] = pools[poolid] + data[:,j] + data[:,k]
-            else:
-                pools[poolid] = pools[poolid] + data[:,j]
+    energies_dft_zero = data.energies
+    sigmas, pis = cohp_orbital_curves(data)
     
     xlim = 40 
     
-    sigmas = pools[0] + pools[1] + pools[2] + pools[3]
-    pis = pools[4] + pools[5] + pools[6] + pools[7]
-    
     labels = ['$\sigma$','$\pi$']
     
-    ax.fill(sigmas, energies_dft_zero, alpha=0.6, color=colors[0],
-            label=labels[0], zorder=4)
-    ax.plot(sigmas, energies_dft_zero, color=colors[0], zorder=2,
-            linewidth=0.7)
-    ax.fill(pis, energies_dft_zero, alpha=0.6, color=colors[1],
-            label=labels[1], zorder=3)
-    ax.plot(pis, energies_dft_zero, color=colors[1], zorder=1,
-            linewidth=0.7)
+    sigma_fill, = ax.fill(sigmas, energies_dft_zero, alpha=0.6, color=colors[0],
+                          label=labels[0], zorder=4)
+    sigma_line, = ax.plot(sigmas, energies_dft_zero, color=colors[0], zorder=2,
+                          linewidth=0.7)
+    pi_fill, = ax.fill(pis, energies_dft_zero, alpha=0.6, color=colors[1],
+                       label=labels[1], zorder=3)
+    pi_line, = ax.plot(pis, energies_dft_zero, color=colors[1], zorder=1,
+                       linewidth=0.7)
 
     ax.set_ylim(-30,10)
     ax.set_xlim(-xlim,xlim)
@@ -393,42 +645,96 @@ def plot_COHP_orbital(ax, data, types, metadata, title=None,
     
     if title:
         ax.set_title(title)
+    
+    return sigma_fill, sigma_line, pi_fill, pi_line
+
+def update_COHP_orbital(artists, data):
+    """
+    Replaces the data of the artists made by plot_COHP_orbital
+    """
+    sigma_fill, sigma_line, pi_fill, pi_line = artists
+    sigmas, pis = cohp_orbital_curves(data)
+    
+    sigma_fill.set_xy(np.column_stack([sigmas, data.energies]))
+    sigma_line.set_data(sigmas, data.energies)
+    pi_fill.set_xy(np.column_stack([pis, data.energies]))
+    pi_line.set_data(pis, data.energies)
+
+def cohp_orbital_curves(data):
+    """
+    Sums the orbital wise COHPs into sigma and pi contributions
+    """
+    energies = data.energies
+    pools = [np.zeros_like(energies) for j in range(0,16)]
+    orbitalpools = ['ss', 'sp_z', 'p_zs', 'p_zp_z', 'p_xp_x', 'p_xp_y', 'p_yp_x', 'p_yp_y',
+                    'sp_x', 'p_xs', 'sp_y', 'p_ys', 'p_xp_z', 'p_zp_x', 'p_yp_z', 'p_zp_y']
+    for i,datatype in enumerate(data.types):
+        if datatype['type'] == 'orbitalwise':
+            intlabel = datatype['orbital1'][1:] + datatype['orbital2'][1:]
+            poolid = orbitalpools.index(intlabel)
+            pools[poolid] = pools[poolid] + data.total(i+1)[0]
+    
+    sigmas = pools[0] + pools[1] + pools[2] + pools[3]
+    pis = pools[4] + pools[5] + pools[6] + pools[7]
+    
+    return sigmas, pis
 
-def find_bondlength(path):
+def find_bondlength(path,store=None,step=None):
     """
     Finds the bondlength between C and O for a CONTCAR in a given path
+    
+    store : trajectory store to read the positions from instead
+    step : 0-based step in the store
     """
     contcar = os.path.join(path,"CONTCAR")
     
-    c_index = atom_index(contcar, 'C') 
-    o_index = atom_index(contcar, 'O') 
+    if store is not None:
+        symbols = store.index['symbols']
+        positions = store.positions[step]
+        c_index = symbols.index('C')
+        o_index = symbols.index('O')
+    else:
+        structure = read_structure(contcar)
+        c_index = structure.index('C')
+        o_index = structure.index('O')
+        positions = structure.positions
     
-    struc = ase.io.read(contcar)
-    bond_dist = struc.positions[o_index][2]-struc.positions[c_index][2]
+    bond_dist = positions[o_index][2]-positions[c_index][2]
     
     return bond_dist
     
-def latex_image(tex, value, name):
+@functools.lru_cache(maxsize=1024)
+def latex_image(tex, value, height=420):
     """ 
-    Generates a latex image with matplotlib and saves it 
+    Generates a latex image with matplotlib in memory and returns it as an
+    RGBA image of the given height in pixels. Images are cached on the
+    formatted value, as distances repeat between steps.
     """
-    plt.figure(figsize=(8,8))
-    plt.axis('off')
-    plt.text(0.05, 0.35, f'${tex}$ {value}', size=250)
-    
-    main_dir = os.path.dirname(__file__)
-    temp_dir = os.path.join(main_dir, "temp")
-    
-    if os.path.isdir(temp_dir) is False:
-        os.mkdir(temp_dir)
-
-    plt.savefig(os.path.join(temp_dir, 'tex_%s.png' %name), bbox_inches = 'tight')
-    plt.close()
+    fig = Figure(figsize=(8,8))
+    canvas = FigureCanvasAgg(fig)
+    ax = fig.add_subplot(111)
+    ax.axis('off')
+    fig.text(0.05, 0.35, f'${tex}$ {value}', size=250)
+    
+    # Same area as bbox_inches='tight', drawn straight at the dpi that gives
+    # the wanted height
+    bbox = fig.get_tightbbox(canvas.get_renderer()).padded(0.1)
+    dpi = height/bbox.height
+    
+    buf = io.BytesIO()
+    fig.savefig(buf, format='rgba', dpi=dpi, bbox_inches=bbox)
+    width = buf.tell()//(4*height)
+    img = Image.frombuffer('RGBA', (width, height), buf.getbuffer(),
+                           'raw', 'RGBA', 0, 1)
+    
+    return img.copy()
   
-def add_distances(img):
+def add_distances(img, rh_c, c_o):
     """
     Adds a white pace next to plot where the distance from surface and bond
     length are shown
+    
+    rh_c, c_o : images of the distances made by latex_image
     """
     size = img.size
     
@@ -436,25 +742,9 @@ def add_distances(img):
                           color=(255,255,255))
     
     base_img.paste(img, (0,0), mask=img)
-    
-    height_text = 420
-    
-    Rh_C = Image.open(os.path.join(os.path.dirname(__file__), 'temp/tex_Rh-C.png')).convert("RGBA")
-    width, height = Rh_C.size
-    ratio = width/height
-    new_height = height_text
-    new_width = int(ratio*new_height) 
-    Rh_C = Rh_C.resize((new_width,new_height))
-    
-    C_O = Image.open(os.path.join(os.path.dirname(__file__), 'temp/tex_C-O.png')).convert("RGBA")
-    width, height = C_O.size
-    ratio = width/height
-    new_height = height_text
-    new_width = int(ratio*new_height) 
-    C_O = C_O.resize((new_width,new_height))
 
-    base_img.paste(Rh_C, (4200,900), mask=Rh_C)
-    base_img.paste(C_O, (4200,1400), mask=C_O)
+    base_img.paste(rh_c, (4200,900), mask=rh_c)
+    base_img.paste(c_o, (4200,1400), mask=c_o)
     
     return base_img
             
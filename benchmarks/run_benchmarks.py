@@ -0,0 +1,254 @@
+import os
+import sys
+import json
+import time
+import shutil
+import socket
+import argparse
+import platform
+import tempfile
+import subprocess
+import numpy as np
+import synthetic
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Benchmarks in the order they run
+BENCHMARKS = ['read_data_DOS', 'read_data_DOS_cached', 'read_data_COHP',
+              'peak_table', 'peak_table_steps', 'visualise_frame',
+              'read_contcar', 'find_bonds', 'video_composite']
+
+def main():
+
+    parser = argparse.ArgumentParser(
+        description='Times the analysis and visualisation steps on synthetic '
+                    'LOBSTER and VASP output and writes the results as JSON')
+    parser.add_argument('--atoms', type=int, default=30,
+                        help='number of atoms, C and O are the last two')
+    parser.add_argument('--nedos', type=int, default=901,
+                        help='number of energies of the DOS and COHP')
+    parser.add_argument('--interactions', type=int, default=1,
+                        help='number of C-O interactions in the COHPCAR, each '
+                             'with 16 orbital-wise entries')
+    parser.add_argument('--steps', type=int, default=300,
+                        help='number of steps of the peak_table_steps benchmark')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='number of runs of every benchmark')
+    parser.add_argument('--only', default=None,
+                        help='comma separated benchmarks to run, default all of '
+                             + ', '.join(BENCHMARKS))
+    parser.add_argument('--output', default=None,
+                        help='JSON file, default benchmarks/results/<commit>.json')
+    parser.add_argument('--compare', default=None,
+                        help='JSON file of an earlier run to compare with')
+    parser.add_argument('--keep', action='store_true',
+                        help='keep the folder with the synthetic files')
+    args = parser.parse_args()
+
+    names = BENCHMARKS
+    if args.only:
+        names = args.only.split(',')
+        for name in names:
+            if name not in BENCHMARKS:
+                raise Exception('Unknown benchmark: %s' % name)
+
+    params = {
+        'atoms' : args.atoms,
+        'nedos' : args.nedos,
+        'interactions' : args.interactions,
+        'steps' : args.steps,
+        'repeat' : args.repeat,
+        }
+
+    work = tempfile.mkdtemp(prefix='benchmark_')
+    print('Writing synthetic files to %s' % work)
+    try:
+        setup_tree(work, args.atoms, args.nedos, args.interactions)
+        results, sizes = run(work, names, args.repeat, args.steps)
+    finally:
+        if args.keep:
+            print('Kept %s' % work)
+        else:
+            shutil.rmtree(work)
+
+    # structure was imported from the copied HPC scripts by run
+    from structure import available_cpus
+    commit = git_commit()
+    output = args.output or os.path.join(os.path.dirname(__file__), 'results',
+                                         '%s.json' % (commit or 'unknown'))
+    report = {
+        'commit' : commit,
+        'date' : time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'host' : socket.gethostname(),
+        'cpus' : available_cpus(),
+        'python' : platform.python_version(),
+        'numpy' : np.__version__,
+        'params' : params,
+        'sizes' : sizes,
+        'results' : results,
+        }
+    if not os.path.isdir(os.path.dirname(os.path.abspath(output))):
+        os.makedirs(os.path.dirname(os.path.abspath(output)))
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=1)
+    print('Results written to %s' % output)
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), report)
+
+def setup_tree(work, atoms, nedos, interactions):
+    """
+    Copies the HPC scripts into work/HPC, which read and write relative to
+    their own folder, next to a synthetic data folder and one output step.
+    The plot and Blender images of the video go to work/video.
+    """
+    hpc = os.path.join(work, 'HPC')
+    os.makedirs(os.path.join(hpc, 'data'))
+    os.makedirs(os.path.join(hpc, 'output', 'images'))
+    for name in os.listdir(os.path.join(REPO, 'HPC')):
+        if name.endswith('.py'):
+            shutil.copy(os.path.join(REPO, 'HPC', name), hpc)
+
+    synthetic.write_step(os.path.join(hpc, 'output', '1'), atoms, nedos,
+                         interactions)
+    shutil.copy(os.path.join(hpc, 'output', '1', 'CONTCAR'),
+                os.path.join(hpc, 'data', 'POSCAR'))
+    with open(os.path.join(hpc, 'data', 'param.txt'), 'w') as f:
+        f.write('2\n1\n')
+
+    synthetic.write_video_images(os.path.join(work, 'video'))
+
+def run(work, names, repeat, steps):
+    """
+    Runs the benchmarks on the files written by setup_tree and returns their
+    timings by name and the sizes of the synthetic system
+    """
+    hpc = os.path.join(work, 'HPC')
+    sys.path.insert(0, hpc)
+    import visualise
+    import peaks
+    import structure
+
+    tpath = os.path.join(hpc, 'output', '1')
+    poscar = os.path.join(hpc, 'data', 'POSCAR')
+    contcar = os.path.join(tpath, 'CONTCAR')
+    sidecar = os.path.join(tpath, 'DOSCAR.lobster.cache.npz')
+    c_index = structure.read_structure(poscar).index('C')
+    o_index = structure.read_structure(poscar).index('O')
+
+    def remove_sidecar():
+        if os.path.isfile(sidecar):
+            os.remove(sidecar)
+
+    e, sigma, pi = visualise.read_data_DOS(tpath, c_index, o_index)
+    sigmas = np.stack([np.roll(sigma, n % 20) for n in range(steps)])
+    pis = np.stack([np.roll(pi, n % 20) for n in range(steps)])
+
+    def peak_tables(s, p):
+        return [peaks.peak_table(s, e, visualise.THRESHOLDS[0]),
+                peaks.peak_table(p, e, visualise.THRESHOLDS[1], offset=s)]
+
+    cases = {
+        'read_data_DOS' : (
+            lambda: visualise.read_data_DOS(tpath, c_index, o_index),
+            remove_sidecar),
+        'read_data_DOS_cached' : (
+            lambda: visualise.read_data_DOS(tpath, c_index, o_index), None),
+        'read_data_COHP' : (lambda: visualise.read_data_COHP(tpath), None),
+        'peak_table' : (lambda: peak_tables(sigma, pi), None),
+        'peak_table_steps' : (lambda: peak_tables(sigmas, pis), None),
+        'visualise_frame' : (lambda: visualise.render_frame(1), None),
+        }
+
+    # The Blender geometry and the video need no Blender or encoder, but
+    # their own folders on the path
+    sys.path.insert(0, os.path.join(REPO, 'local', 'blender'))
+    sys.path.insert(0, os.path.join(REPO, 'local', 'video'))
+    import geometry
+    import make_video
+
+    def clear_structures():
+        structure._read_structure.cache_clear()
+
+    molecule = geometry.read_contcar(contcar)
+    cases['read_contcar'] = (lambda: geometry.read_contcar(contcar),
+                             clear_structures)
+    cases['find_bonds'] = (lambda: geometry.find_bonds(*molecule), None)
+
+    video = os.path.join(work, 'video')
+    box = make_video.frame_geometry(synthetic_plot_size(video))
+    cases['video_composite'] = (
+        lambda: make_video.composite_frame(video, 1, box), None)
+
+    results = {}
+    for name in names:
+        function, setup = cases[name]
+        results[name] = measure(function, repeat, setup)
+        print('%-22s %10.4f s  (median of %i, first %.4f s)' %
+              (name, results[name]['median'], repeat, results[name]['first']))
+    sizes = {
+        'bonds' : int(len(geometry.find_bonds(*molecule)['pairs'])),
+        'scene_atoms' : int(len(molecule[2])),
+        'doscar_mb' : os.path.getsize(os.path.join(tpath, 'DOSCAR.lobster')) / 1e6,
+        'cohpcar_mb' : os.path.getsize(os.path.join(tpath, 'COHPCAR.lobster')) / 1e6,
+        }
+    return results, sizes
+
+def synthetic_plot_size(video):
+    """
+    Returns the size of the plot image written by write_video_images
+    """
+    from PIL import Image
+    return Image.open(os.path.join(video, 'plot_images', '1.png')).size
+
+def measure(function, repeat, setup=None):
+    """
+    Runs a function repeat times and returns the seconds of the first run and
+    the minimum, median and mean over all runs
+
+    setup : called before every run, not timed
+    """
+    times = []
+    for n in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return {
+        'runs' : repeat,
+        'first' : times[0],
+        'min' : min(times),
+        'median' : float(np.median(times)),
+        'mean' : float(np.mean(times)),
+        }
+
+def compare(old, new):
+    """
+    Prints the median time of every benchmark against an earlier run
+    """
+    if old['params'] != new['params']:
+        print('Parameters differ from %s: %s' % (old['commit'], old['params']))
+    print('%-22s %10s %10s %8s' % ('benchmark', old['commit'] or 'old',
+                                   new['commit'] or 'new', 'ratio'))
+    for name, result in new['results'].items():
+        if name not in old['results']:
+            continue
+        before = old['results'][name]['median']
+        after = result['median']
+        print('%-22s %10.4f %10.4f %8.2f' % (name, before, after, after / before))
+
+def git_commit():
+    """
+    Returns the short hash of the checked out commit, None outside git
+    """
+    try:
+        out = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO,
+                             capture_output=True, text=True, check=True)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return out.stdout.strip()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,179 @@
+import os
+import numpy as np
+from PIL import Image, ImageDraw
+
+# Orbitals LOBSTER projects on, Rh for the slab and C and O for the molecule
+SLAB_ORBITALS = ['5s', '4d_xy', '4d_yz', '4d_z^2', '4d_xz', '4d_x^2-y^2']
+MOLECULE_ORBITALS = ['2s', '2p_y', '2p_z', '2p_x']
+
+# Lattice constant of the Rh(111) surface cell and distance between layers
+SURFACE_A = 2.7039763312573579
+LAYER_DISTANCE = 2.2
+C_HEIGHT = 29.652349912212305
+
+def write_doscar(filename, natoms=30, nedos=901, seed=0):
+    """
+    Writes a DOSCAR.lobster with a Rh slab and C and O as the last two atoms.
+    The DOS of C and O has gaussian peaks where the sigma and pi peaks of CO
+    are, the slab gets smooth oscillations.
+
+    filename : DOSCAR.lobster file
+    natoms : number of atoms, at least 3
+    nedos : number of energies
+    seed : seed of the noise
+    """
+    rng = np.random.default_rng(seed)
+    energies = np.linspace(-30, 15, nedos)
+    header = '%12.5f%12.5f%7i%12.5f%12.8f' % (15, -30, nedos, 0, 1)
+
+    with open(filename, 'w') as f:
+        f.write('%7i%7i%7i%7i\n' % (natoms, natoms, 1, 0))
+        f.write('  0.1E+02  0.2E-09  0.2E-09  0.4E-08  0.5E-15\n')
+        f.write('  1.0E-04\n  CAR\n  LOBSTER\n')
+        f.write(header + '\n')
+        total = rng.random((nedos, 1))
+        np.savetxt(f, np.column_stack([energies, total,
+                                       np.cumsum(total, axis=0)]),
+                   fmt='%12.5f')
+
+        centres = np.array([-24, -10, -7, -6, 3, 6]) + seed * 0.05
+        peaks = np.exp(-((energies[:,None] - centres) / 0.4) ** 2) * 4
+        for atom in range(natoms):
+            if atom < natoms - 2:
+                orbitals = SLAB_ORBITALS
+                dos = np.abs(np.sin(energies[:,None] * (atom + 1) / 7 +
+                                    np.arange(len(orbitals))) * 3)
+            else:
+                orbitals = MOLECULE_ORBITALS
+                dos = np.column_stack([peaks[:,[0,1,4]].sum(1), peaks[:,3],
+                                       peaks[:,[0,2,5]].sum(1), peaks[:,3]])
+            dos = dos + rng.normal(0, 0.01, dos.shape)
+            f.write(header + '; Z= 6; ' + ' '.join(orbitals) + '\n')
+            np.savetxt(f, np.column_stack([energies, dos]), fmt='%12.5f')
+
+def write_cohpcar(filename, natoms=30, nedos=901, interactions=1, seed=0):
+    """
+    Writes a COHPCAR.lobster with the total and the orbital-wise COHP of
+    every interaction between a C and an O atom
+
+    filename : COHPCAR.lobster file
+    natoms : number of atoms, C and O are the last two
+    nedos : number of energies
+    interactions : number of C-O pairs, the first one is the real pair and
+                   the others are labelled with slab atoms
+    seed : seed of the noise
+    """
+    rng = np.random.default_rng(seed)
+    energies = np.linspace(-30, 15, nedos)
+
+    names = ['Average']
+    for n in range(interactions):
+        c = natoms - 1 if n == 0 else n
+        o = natoms if n == 0 else n + 1
+        names.append('No.%i:C%i->O%i(1.15)' % (len(names), c, o))
+        for a in MOLECULE_ORBITALS:
+            for b in MOLECULE_ORBITALS:
+                names.append('No.%i:C%i[%s]->O%i[%s](1.15)' %
+                             (len(names), c, a, o, b))
+
+    columns = [energies]
+    for k in range(len(names)):
+        cohp = np.sin(energies * (k + 1) / 5) + rng.normal(0, 0.01, nedos)
+        columns += [cohp, np.cumsum(cohp) * 0.05]
+
+    with open(filename, 'w') as f:
+        f.write('COHPCAR.lobster from synthetic benchmark data\n')
+        f.write('%7i%7i%7i%12.5f%12.5f%12.5f\n' %
+                (len(names), 1, nedos, -30, 15, 0))
+        for name in names:
+            f.write(name + '\n')
+        np.savetxt(f, np.column_stack(columns), fmt='%12.5f')
+
+def write_contcar(filename, natoms=30, seed=0):
+    """
+    Writes a CONTCAR of CO on top of a Rh(111) slab in direct coordinates
+    with selective dynamics. The slab keeps 7 layers and grows sideways with
+    the number of atoms, C sits at the height of the real system.
+
+    filename : CONTCAR file
+    natoms : number of atoms, at least 3
+    seed : seed of the displacements of the slab atoms
+    """
+    rng = np.random.default_rng(seed)
+    nslab = natoms - 2
+    size = max(int(np.ceil(np.sqrt(nslab / 7))), 1)
+    layers = int(np.ceil(nslab / size**2))
+    c = C_HEIGHT + 1.15 + 15
+
+    lattice = np.array([[size*SURFACE_A, 0, 0],
+                        [size*SURFACE_A/2, size*SURFACE_A*np.sqrt(3)/2, 0],
+                        [0, 0, c]])
+
+    # fcc stacking of the layers downwards from the top layer under C
+    top = C_HEIGHT - 1.9
+    positions = []
+    for layer in range(layers):
+        shift = (layer % 3) / 3
+        for i in range(size):
+            for j in range(size):
+                positions.append([(i + shift) / size, (j + shift) / size,
+                                  (top - layer*LAYER_DISTANCE) / c])
+    slab = np.array(positions[:nslab])
+    slab[:,2] += rng.normal(0, 0.002, nslab)
+    slab = slab[np.argsort(slab[:,2], kind='stable')]
+    molecule = np.array([[0, 0, C_HEIGHT / c], [0, 0, (C_HEIGHT + 1.15) / c]])
+
+    with open(filename, 'w') as f:
+        f.write('Rh C O\n 1.0000000000000000\n')
+        for vector in lattice:
+            f.write('  %20.16f  %20.16f  %20.16f\n' % tuple(vector))
+        f.write('   Rh   C    O\n  %4i  %4i  %4i\n' % (nslab, 1, 1))
+        f.write('Selective dynamics\nDirect\n')
+        for p in slab:
+            f.write('  %19.16f %19.16f %19.16f   F   F   T\n' % tuple(p))
+        f.write('  %19.16f %19.16f %19.16f   F   F   F\n' % tuple(molecule[0]))
+        f.write('  %19.16f %19.16f %19.16f   F   F   T\n' % tuple(molecule[1]))
+
+def write_step(folder, natoms=30, nedos=901, interactions=1, distance=0.5,
+               seed=0):
+    """
+    Writes the output folder of one step: DOSCAR.lobster, COHPCAR.lobster,
+    CONTCAR and param.txt
+    """
+    if not os.path.isdir(folder):
+        os.makedirs(folder)
+    write_doscar(os.path.join(folder, 'DOSCAR.lobster'), natoms, nedos, seed)
+    write_cohpcar(os.path.join(folder, 'COHPCAR.lobster'), natoms, nedos,
+                  interactions, seed)
+    write_contcar(os.path.join(folder, 'CONTCAR'), natoms, seed)
+    with open(os.path.join(folder, 'param.txt'), 'w') as f:
+        f.write('%f\n' % distance)
+
+def write_video_images(folder, step=1, plot_size=(6300, 4200), syst_size=512):
+    """
+    Writes a plot image and a Blender image of one step for make_video.py,
+    with lines and shapes on a plain background so they compress like the
+    real images
+
+    folder : folder which gets plot_images and syst_images
+    """
+    for name in ['plot_images', 'syst_images']:
+        if not os.path.isdir(os.path.join(folder, name)):
+            os.makedirs(os.path.join(folder, name))
+
+    plot = Image.new('RGB', plot_size, 'white')
+    draw = ImageDraw.Draw(plot)
+    width, height = plot_size
+    x = np.linspace(0, width, 2000)
+    for k, color in enumerate(['#fe6100', '#648fff', '#000000']):
+        y = height/2 + height/4 * np.sin(x / width * (k+2) * np.pi + k)
+        draw.line(list(zip(x, y)), fill=color, width=8)
+    plot.save(os.path.join(folder, 'plot_images', '%i.png' % step))
+
+    syst = Image.new('RGBA', (syst_size, syst_size), (0, 0, 0, 0))
+    draw = ImageDraw.Draw(syst)
+    for k in range(7):
+        r = syst_size / 10
+        x, y = syst_size * (0.2 + 0.1*k), syst_size * (0.3 + 0.05*k)
+        draw.ellipse([x-r, y-r, x+r, y+r], fill=(10, 125, 140, 255))
+    syst.save(os.path.join(folder, 'syst_images', '%i.png' % step))
@@ -0,0 +1,234 @@
+import os
+import sys
+import itertools
+import numpy as np
+
+# The POSCAR and CONTCAR files are parsed by structure.py of the HPC scripts
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             '..', '..', 'HPC'))
+from structure import read_structure
+
+# Position of the adsorbed carbon at zero distance, placed at the origin
+SHIFT = np.array([1.3519881656286596, 0.7805707313668949, 29.652349912212305])
+
+# Atoms below this height are left out of the scene
+Z_CUT = -6
+
+# Largest distance in Angstrom between two bonded atoms, per pair of elements
+BOND_CUTOFF = 2.3
+BOND_CUTOFFS = {}
+
+def read_contcar(filename, replicate=('Rh',), size=2, z_cut=Z_CUT):
+    """
+    Reads a CONTCAR and places it in the scene
+
+    Returns the element names, the element of every atom as an index into
+    the names and the cartesian positions (atoms, 3). Atoms of the elements
+    in replicate are repeated over a (2*size+1) x (2*size+1) grid of cells,
+    every atom is followed by its images.
+
+    filename : CONTCAR file
+    replicate : elements which are repeated in x and y
+    size : number of cells added on each side
+    z_cut : atoms below this height are left out, None keeps all
+    """
+    structure = read_structure(filename)
+    elements = list(structure.species)
+    codes = structure.codes
+    natoms = structure.natoms
+    frac = structure.direct
+    matrix = structure.lattice
+
+    # Every atom with its images, the original cell first
+    images = np.array([(0,0,0)] + [(x,y,0) for x in range(-size,size+1)
+                                   for y in range(-size,size+1)
+                                   if x != 0 or y != 0], dtype=float)
+    repeated = np.isin(np.array(elements)[codes], replicate)
+    nimages = np.where(repeated, len(images), 1)
+    atom = np.repeat(np.arange(natoms), nimages)
+    image = np.arange(len(atom)) - np.repeat(np.cumsum(nimages) - nimages,
+                                             nimages)
+
+    positions = shift_struc((frac[atom] + images[image]) @ matrix)
+    if z_cut is None:
+        return elements, codes[atom], positions
+    keep = positions[:,2] > z_cut
+
+    return elements, codes[atom][keep], positions[keep]
+
+def read_trajectory(filenames, z_cut=Z_CUT):
+    """
+    Reads the CONTCARs of all frames
+
+    Returns the element names, the element codes and the positions
+    (frames, atoms, 3). The atoms are the same in every frame, the ones
+    above z_cut in the first frame.
+
+    filenames : CONTCAR of every frame
+    z_cut : atoms below this height in the first frame are left out
+    """
+    frames = [read_contcar(f, z_cut=None) for f in filenames]
+    elements, codes, first = frames[0]
+    for f, frame in zip(filenames, frames):
+        if frame[0] != elements or not np.array_equal(frame[1], codes):
+            raise Exception('Atoms of %s differ from %s' % (f, filenames[0]))
+
+    keep = first[:,2] > z_cut
+    positions = np.stack([frame[2][keep] for frame in frames])
+    return elements, codes[keep], positions
+
+def trajectory_bonds(elements, codes, positions, **kwargs):
+    """
+    Finds the bonds of every frame of a trajectory
+
+    Returns the pairs bonded in any frame (bonds, 2) and the two ends of
+    every bond in every frame (frames, 2*bonds, 3). In frames where a pair
+    is not bonded both ends are at its midpoint, so the bond has no length.
+
+    elements, codes, positions : trajectory returned by read_trajectory
+    kwargs : cutoffs and default of find_bonds
+    """
+    frames = [find_bonds(elements, codes, p, **kwargs) for p in positions]
+    pairs = np.unique(np.concatenate([f['pairs'] for f in frames]), axis=0)
+    pairs = pairs.reshape(-1, 2)
+
+    start = positions[:,pairs[:,0]]
+    end = positions[:,pairs[:,1]]
+    midpoints = (start + end) / 2
+    # a pair i, j as the single number i*atoms + j
+    natoms = positions.shape[1]
+    keys = pairs[:,0]*natoms + pairs[:,1]
+    bonded = np.stack([np.isin(keys, f['pairs'][:,0]*natoms + f['pairs'][:,1])
+                       for f in frames])
+    start = np.where(bonded[...,None], start, midpoints)
+    end = np.where(bonded[...,None], end, midpoints)
+    ends = np.stack([start, end], axis=2).reshape(len(frames), -1, 3)
+    return pairs, ends
+
+def shift_struc(xyz):
+    """
+    Places the structure on a predefined location
+    uses the zero position of the carbon adsorbed
+
+    xyz : cartesian positions (..., 3)
+    """
+    return xyz - SHIFT
+
+def find_bonds(elements, codes, positions, cutoffs=None, default=BOND_CUTOFF,
+               cell=None):
+    """
+    Finds the bonds between atoms with a cell list
+
+    Returns a dict of arrays with one entry per bond, sorted by atom:
+    pairs : indices of the two atoms (bonds, 2)
+    shift : translation of the second atom to its periodic image
+    midpoints : middle of the bond
+    lengths : length of the bond
+    axes, angles : rotation of the z axis onto the bond
+
+    elements, codes, positions : structure returned by read_contcar
+    cutoffs : largest bond length per pair of elements, e.g. {('C','O'): 1.5},
+              pairs not listed use default
+    default : largest bond length of the other pairs
+    cell : unitcell matrix, bonds to the images of the atoms in the plane of
+           the first two vectors are found without replicating the atoms
+    """
+    positions = np.asarray(positions, dtype=float)
+    codes = np.asarray(codes)
+
+    # Cutoff of every pair of elements
+    table = np.full((len(elements), len(elements)), float(default))
+    pairs = dict(BOND_CUTOFFS)
+    pairs.update(cutoffs or {})
+    for (a, b), cutoff in pairs.items():
+        if a in elements and b in elements:
+            table[elements.index(a), elements.index(b)] = cutoff
+            table[elements.index(b), elements.index(a)] = cutoff
+
+    if cell is None:
+        i, j = neighbour_pairs(positions, table.max())
+        shift = np.zeros((len(i), 3))
+    else:
+        # The atoms together with their 8 neighbouring images in the plane,
+        # pairs are kept once, starting in the original cell
+        cell = np.asarray(cell, dtype=float)
+        images = np.array([(0,0)] + [(x,y) for x in (-1,0,1) for y in (-1,0,1)
+                                     if x != 0 or y != 0]) @ cell[:2]
+        n = len(positions)
+        ghosts = (positions[None] + images[:,None]).reshape(-1, 3)
+        i, j = neighbour_pairs(ghosts, table.max())
+        keep = i < n
+        i, j = i[keep], j[keep]
+        shift = images[j // n]
+        j = j % n
+        sign = np.sign(shift[:,0]) * 2 + np.sign(shift[:,1])
+        keep = (i < j) | ((i == j) & (sign > 0))
+        i, j, shift = i[keep], j[keep], shift[keep]
+
+    vectors = positions[j] + shift - positions[i]
+    lengths = np.linalg.norm(vectors, axis=1)
+    keep = lengths < table[codes[i], codes[j]]
+    order = np.lexsort((j[keep], i[keep]))
+    i, j = i[keep][order], j[keep][order]
+    shift, vectors, lengths = shift[keep][order], vectors[keep][order], \
+                              lengths[keep][order]
+
+    axes, angles = rotation_to(vectors)
+    return {
+        'pairs' : np.column_stack([i, j]),
+        'shift' : shift,
+        'midpoints' : positions[i] + vectors / 2,
+        'lengths' : lengths,
+        'axes' : axes,
+        'angles' : angles,
+        }
+
+def neighbour_pairs(positions, cutoff):
+    """
+    Returns all pairs of atoms i < j which may be closer than cutoff, found
+    by sorting the atoms into cubes of size cutoff and comparing every atom
+    only with the atoms in its own and the 26 neighbouring cubes
+
+    positions : cartesian positions (atoms, 3)
+    cutoff : largest distance of interest
+    """
+    n = len(positions)
+    if n < 2:
+        return np.zeros(0, dtype=int), np.zeros(0, dtype=int)
+
+    # Cube of every atom, with an empty layer around all cubes so neighbouring
+    # cubes never wrap around
+    cubes = np.floor((positions - positions.min(axis=0)) / cutoff).astype(int) + 1
+    dims = cubes.max(axis=0) + 2
+    keys = np.ravel_multi_index(cubes.T, dims)
+    order = np.argsort(keys, kind='stable')
+    sorted_keys = keys[order]
+
+    first = []
+    second = []
+    for offset in itertools.product((-1,0,1), repeat=3):
+        neighbours = np.ravel_multi_index((cubes + offset).T, dims)
+        start = np.searchsorted(sorted_keys, neighbours, 'left')
+        counts = np.searchsorted(sorted_keys, neighbours, 'right') - start
+        i = np.repeat(np.arange(n), counts)
+        j = order[np.repeat(start - np.cumsum(counts) + counts, counts)
+                  + np.arange(counts.sum())]
+        first.append(i[i < j])
+        second.append(j[i < j])
+    return np.concatenate(first), np.concatenate(second)
+
+def rotation_to(vectors):
+    """
+    Returns the axes and angles rotating the z axis onto vectors, as used for
+    the rotation of the bond cylinders
+    """
+    lengths = np.linalg.norm(vectors, axis=1)
+    axes = np.cross([0,0,1], vectors)
+    norm = np.linalg.norm(axes, axis=1)
+
+    # Bonds along z need no axis, any axis in the plane will do
+    along_z = norm < 1e-12
+    axes[along_z] = (1,0,0)
+    norm[along_z] = 1
+    angles = np.arccos(np.clip(vectors[:,2] / lengths, -1, 1))
+    return axes / norm[:,None], angles
@@ -0,0 +1,177 @@
+import os
+import sys
+import argparse
+import subprocess
+
+# The cores are counted by structure.py of the HPC scripts
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             '..', '..', 'HPC'))
+from structure import available_cpus
+
+def main():
+
+    folder = os.path.dirname(os.path.abspath(__file__))
+
+    parser = argparse.ArgumentParser(
+        description='Renders the frames with several Blender processes or a '
+                    'SLURM array, rerunning frames whose image is missing')
+    parser.add_argument('--root', default='rootfolder',
+                        help='folder with positions/<n>/CONTCAR')
+    parser.add_argument('--frames', default=None,
+                        help='frames to render, e.g. 1-300 or 1-10,15, '
+                             'default all frames with a CONTCAR')
+    parser.add_argument('--stride', type=int, default=1,
+                        help='render every stride-th frame')
+    parser.add_argument('--output', default=None,
+                        help='folder of the images, default root/images')
+    parser.add_argument('--workers', type=int, default=4,
+                        help='number of Blender processes or array tasks')
+    parser.add_argument('--profile', default='production',
+                        help='render profile of script.py')
+    parser.add_argument('--retries', type=int, default=2,
+                        help='number of times missing frames are rerun')
+    parser.add_argument('--blender', default=os.environ.get('BLENDER', 'blender'),
+                        help='Blender executable')
+    parser.add_argument('--blend', default=os.path.join(folder, 'structures.blend'),
+                        help='Blender file with camera and light')
+    parser.add_argument('--slurm', action='store_true',
+                        help='submit a SLURM array instead of running here, '
+                             'run again afterwards to rerun missing frames')
+    parser.add_argument('--submit-script',
+                        default=os.path.join(folder, 'run_blender.submit'),
+                        help='SLURM script running one array task')
+    args = parser.parse_args()
+
+    # the Blender processes may run in another directory
+    root = os.path.abspath(args.root)
+    frames = select_frames(root, args.frames, args.stride)
+    output = os.path.abspath(args.output or os.path.join(root, 'images'))
+    options = ['--root', root, '--output', output,
+               '--profile', args.profile]
+
+    for attempt in range(args.retries + 1):
+        missing = missing_frames(output, frames)
+        if not missing:
+            break
+        print('Rendering %i frames: %s' % (len(missing), format_frames(missing)))
+
+        if args.slurm:
+            submit(missing, args.workers, options, args.submit_script)
+            return
+        run_local(missing, args.workers, options, args.blender, args.blend,
+                  output)
+
+    missing = missing_frames(output, frames)
+    if missing:
+        raise Exception('Frames %s failed' % format_frames(missing))
+    print('All %i frames rendered' % len(frames))
+
+def parse_frames(text):
+    """
+    Parses a selection of frames like 1-10,15
+    """
+    frames = []
+    for part in text.split(','):
+        if '-' in part:
+            first, last = part.split('-')
+            frames.extend(range(int(first), int(last)+1))
+        else:
+            frames.append(int(part))
+    return sorted(set(frames))
+
+def format_frames(frames):
+    """
+    Writes frames in the format read by parse_frames
+    """
+    parts = []
+    for n in sorted(frames):
+        if parts and parts[-1][1] == n - 1:
+            parts[-1][1] = n
+        else:
+            parts.append([n, n])
+    return ','.join('%i' % a if a == b else '%i-%i' % (a, b) for a, b in parts)
+
+def find_frames(root):
+    """
+    Returns the steps 1, 2, ... which have a CONTCAR in root/positions
+    """
+    frames = []
+    while os.path.isfile(os.path.join(root, 'positions/%i/CONTCAR'
+                                            % (len(frames)+1))):
+        frames.append(len(frames)+1)
+    return frames
+
+def select_frames(root, frames=None, stride=1, worker=0, workers=1):
+    """
+    Returns the frames of one worker
+
+    root : folder with positions/<n>/CONTCAR
+    frames : selection read by parse_frames, default all frames
+    stride : take every stride-th frame
+    worker, workers : the frames are dealt out over the workers in turn, so
+                      every worker gets frames from the whole trajectory
+    """
+    if frames is None:
+        frames = find_frames(root)
+    else:
+        frames = parse_frames(frames)
+    return frames[::stride][worker::workers]
+
+def image_complete(path):
+    """
+    Returns whether a PNG image exists and was written to the end
+    """
+    if not os.path.isfile(path) or os.path.getsize(path) < 12:
+        return False
+    with open(path, 'rb') as f:
+        f.seek(-12, os.SEEK_END)
+        return b'IEND' in f.read()
+
+def missing_frames(output, frames):
+    """
+    Returns the frames without a complete image in output
+    """
+    return [n for n in frames
+            if not image_complete(os.path.join(output, '%i.png' % n))]
+
+def run_local(frames, workers, options, blender='blender', blend=None,
+              output='.'):
+    """
+    Renders frames with several Blender processes at once, sharing the
+    cores of this machine
+    """
+    folder = os.path.dirname(os.path.abspath(__file__))
+    workers = max(min(workers, len(frames)), 1)
+    threads = max(available_cpus() // workers, 1)
+    if not os.path.isdir(output):
+        os.makedirs(output)
+
+    processes = []
+    for worker in range(workers):
+        command = [blender, blend, '--background',
+                   '--python', os.path.join(folder, 'script.py'), '--',
+                   '--frames', format_frames(frames), '--worker', '%i' % worker,
+                   '--workers', '%i' % workers, '--threads', '%i' % threads,
+                   '--skip-existing'] + options
+        log = open(os.path.join(output, 'blender_%i.log' % worker), 'w')
+        processes.append((subprocess.Popen(command, stdout=log,
+                                           stderr=subprocess.STDOUT), log))
+    for process, log in processes:
+        process.wait()
+        log.close()
+
+def submit(frames, workers, options, script='run_blender.submit',
+           sbatch='sbatch'):
+    """
+    Submits an array job with one task per worker
+    """
+    workers = max(min(workers, len(frames)), 1)
+    command = [sbatch, '--array=0-%i' % (workers-1), script,
+               '--frames', format_frames(frames), '--workers', '%i' % workers,
+               '--skip-existing'] + options
+    print(' '.join(command))
+    subprocess.run(command, check=True,
+                   cwd=os.path.dirname(os.path.abspath(script)))
+
+if __name__ == '__main__':
+    main()
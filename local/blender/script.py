@@ -1,8 +1,18 @@
 import bpy
+import bmesh
 import numpy as np
+import argparse
 import os
+import sys
 import time
 
+# geometry.py lives next to this script, which Blender does not put on the path
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from geometry import read_contcar, read_trajectory, find_bonds, \
+                     trajectory_bonds
+from launch import select_frames, missing_frames
+from structure import available_cpus
+
 atom_radii = {
     'H': 0.2,
     'C': 0.5,
@@ -21,98 +31,320 @@ settings = {
         'resolution': 512,
         'camera_location': (-10,0,2.5),
         'camera_rotation': (85/90*np.pi/2,0,-np.pi/2),
-        'camera_scale' : 7.5
+        'camera_scale' : 7.5,
+        'animate' : True,
+        'profile' : 'production',
+        'benchmark' : False
     }
 
+# Cycles settings for the CPU render nodes. Adaptive sampling stops
+# sampling pixels once their noise is below the threshold and the denoiser
+# removes what is left, so far fewer samples than the fixed 512 are needed.
+render_profiles = {
+    'preview': {
+        'samples': 64,
+        'adaptive_threshold': 0.05,
+        'adaptive_min_samples': 8,
+        'denoise': True,
+        'bounces': (4, 2, 2, 2, 4),
+        'tile_size': 256
+    },
+    'production': {
+        'samples': 256,
+        'adaptive_threshold': 0.01,
+        'adaptive_min_samples': 32,
+        'denoise': True,
+        'bounces': (8, 4, 4, 4, 8),
+        'tile_size': 2048
+    },
+    # high sample count without shortcuts, used as reference by benchmark
+    'reference': {
+        'samples': 4096,
+        'adaptive_threshold': 0,
+        'adaptive_min_samples': 0,
+        'denoise': False,
+        'bounces': (12, 4, 4, 12, 8),
+        'tile_size': 2048
+    }
+}
+
 def main():
+    args = parse_args(sys.argv)
+    
     # set the scene
     set_environment(settings)
+    apply_profile(args.profile, args.threads)
     
     # clear any remaining objects
     prune_scene()
     
     # read molecule file and load it
-    root = "rootfolder"
+    root = args.root
+    output = args.output or os.path.join(root, 'images')
     
-    for i in range(0,1):
-        mol = read_contcar(os.path.join(root, 'positions/%i/CONTCAR' %(i+1)))
-        create_atoms(mol)
-        create_bonds(mol)   
-        render_scene(os.path.join(root, 'images/%i.png' % (i+1)))
+    if args.benchmark:
+        benchmark(root, select_frames(root, args.frames)[0])
+        return
+    
+    frames = select_frames(root, args.frames, args.stride, args.worker,
+                           args.workers)
+    if args.skip_existing:
+        frames = missing_frames(output, frames)
+    if not frames:
+        print('No frames to render')
+        return
+    if not os.path.isdir(output):
+        os.makedirs(output)
+    
+    # build the scene once and move the atoms, or build it for every frame
+    if settings['animate'] and not args.rebuild:
+        animate(root, frames, output)
+        return
+    
+    for i in frames:
+        mol = read_contcar(os.path.join(root, 'positions/%i/CONTCAR' % i))
+        create_atoms(*mol)
+        create_bonds(*mol)
+        render_scene(os.path.join(output, '%i.png' % i))
         prune_scene()
-        
-        
-        
+
+def parse_args(argv):
+    """
+    Read the arguments given to the script after -- on the Blender command
+    line
+    """
+    parser = argparse.ArgumentParser(
+        prog='blender structures.blend --background --python script.py --',
+        description='Renders the CONTCARs of root/positions')
+    parser.add_argument('--root', default='rootfolder',
+                        help='folder with positions/<n>/CONTCAR')
+    parser.add_argument('--frames', default=None,
+                        help='frames to render, e.g. 1-300 or 1-10,15, '
+                             'default all frames with a CONTCAR')
+    parser.add_argument('--stride', type=int, default=1,
+                        help='render every stride-th frame')
+    parser.add_argument('--output', default=None,
+                        help='folder of the images, default root/images')
+    parser.add_argument('--skip-existing', action='store_true',
+                        help='only render frames without a complete image')
+    parser.add_argument('--worker', type=int, default=0,
+                        help='render only the frames of this worker')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='number of workers the frames are dealt out to')
+    parser.add_argument('--profile', default=settings['profile'],
+                        choices=sorted(render_profiles))
+    parser.add_argument('--threads', type=int, default=None,
+                        help='render threads, default all available cores')
+    parser.add_argument('--rebuild', action='store_true',
+                        help='build the scene for every frame instead of '
+                             'keyframing the atoms')
+    parser.add_argument('--benchmark', action='store_true',
+                        default=settings['benchmark'],
+                        help='compare the render profiles on the first frame')
+    if '--' in argv:
+        return parser.parse_args(argv[argv.index('--')+1:])
+    return parser.parse_args([])
+
+def animate(root, frames, output):
+    """
+    Build the scene once from the first CONTCAR, keyframe the positions of
+    the atoms and bond ends of all frames and render them in one session
+    
+    root : folder with positions/<n>/CONTCAR
+    frames : steps to render
+    output : folder of the images
+    """
+    elements, codes, positions = read_trajectory(
+        [os.path.join(root, 'positions/%i/CONTCAR' % i) for i in frames])
+    
+    clouds = create_atoms(elements, codes, positions[0])
+    for code, element in enumerate(elements):
+        if element in clouds:
+            keyframe_vertices(clouds[element].data, frames,
+                              positions[:,codes == code])
+    
+    # bonds breaking along the trajectory shrink to their midpoint
+    pairs, ends = trajectory_bonds(elements, codes, positions)
+    bonds = bond_object(ends[0])
+    keyframe_vertices(bonds.data, frames, ends)
+    
+    render_animation(output, frames)
+
+def keyframe_vertices(mesh, frames, coords):
+    """
+    Keyframe the positions of all vertices of a mesh, filling the fcurves
+    in bulk
+    
+    mesh : mesh whose vertices move
+    frames : frame of every set of positions
+    coords : positions of the vertices in every frame (frames, vertices, 3)
+    """
+    mesh.animation_data_create()
+    action = bpy.data.actions.new('%s-action' % mesh.name)
+    mesh.animation_data.action = action
+    
+    frames = np.asarray(frames, dtype=np.float32)
+    for v in range(coords.shape[1]):
+        for axis in range(3):
+            fcurve = action.fcurves.new('vertices[%i].co' % v, index=axis)
+            fcurve.keyframe_points.add(len(frames))
+            fcurve.keyframe_points.foreach_set('co', np.column_stack(
+                [frames, coords[:,v,axis]]).astype(np.float32).ravel())
+            fcurve.update()
+
 def prune_scene():
-    for obj in bpy.data.objects:
+    """
+    Remove the atoms, bonds and their meshes, node groups and materials
+    """
+    for obj in list(bpy.data.objects):
         if obj.name.startswith('atom') or \
            obj.name.startswith('bond') or \
            obj.name.startswith('isosurface'):
-            bpy.ops.object.select_all(action='DESELECT')
-            obj.select_set(True)
-            bpy.ops.object.delete(use_global=False)
+            bpy.data.objects.remove(obj, do_unlink=True)
+    for mesh in list(bpy.data.meshes):
+        if mesh.name.startswith('atom') or mesh.name.startswith('bond'):
+            bpy.data.meshes.remove(mesh)
+    for group in list(bpy.data.node_groups):
+        if group.name.startswith('bond'):
+            bpy.data.node_groups.remove(group)
 
     # finally delete all materials
-    for material in bpy.data.materials:
+    for material in list(bpy.data.materials):
         material.user_clear()
         bpy.data.materials.remove(material)
 
-def create_atoms(mol):
+def create_atoms(elements, codes, positions):
     """
-    Create atoms
+    Create atoms, one sphere per element instanced on the vertices of a
+    point cloud of the positions of that element
+    
+    Returns the point cloud object of every element
+    
+    elements, codes, positions : structure returned by read_contcar
     """
-    for i,at in enumerate(mol):
-        scale = atom_radii[at[0]]
-        bpy.ops.surface.primitive_nurbs_surface_sphere_add(
-            radius=scale, 
-            enter_editmode=False, 
-            align='WORLD', 
-            location=at[1])
-        obj = bpy.context.view_layer.objects.active
-        obj.name = "atom-%s-%03i" % (at[0],i)
-        bpy.ops.object.shade_smooth()
+    clouds = {}
+    for code, element in enumerate(elements):
+        selected = np.flatnonzero(codes == code)
+        if len(selected) == 0:
+            continue
+        cloud = point_object('atom-%s' % element, positions[selected])
+        cloud.instance_type = 'VERTS'
         
-        # set a material
-        mat = create_material(at[0], atom_colors[at[0]])
-        print(mat)
-        obj.data.materials.append(mat)
+        # the sphere is only shown on the vertices of its parent
+        sphere = bpy.data.objects.new('atom-sphere-%s' % element,
+                                      sphere_mesh(element))
+        bpy.context.scene.collection.objects.link(sphere)
+        sphere.parent = cloud
+        clouds[element] = cloud
+    return clouds
+
+def create_bonds(elements, codes, positions):
+    """
+    Create bonds between atoms as the edges of one mesh, turned into tubes
+    by a Geometry Nodes modifier
+    
+    Returns the bond object and the bonds found by find_bonds
+    
+    elements, codes, positions : structure returned by read_contcar
+    """
+    bonds = find_bonds(elements, codes, positions)
+    return bond_object(bond_ends(positions, bonds)), bonds
 
-def create_bonds(mol):
+def bond_object(ends):
     """
-    Create bonds between atoms
+    Create the bond object from the two ends of every bond
     """
-    # set default orientation of bonds (fixed!)
-    z = np.array([0,0,1])
+    # every bond has its own two vertices, so no bonds are joined into one
+    # curve at an atom
+    mesh = bpy.data.meshes.new('bond-mesh')
+    mesh.vertices.add(len(ends))
+    mesh.vertices.foreach_set('co', ends.astype(np.float32).ravel())
+    mesh.edges.add(len(ends) // 2)
+    mesh.edges.foreach_set('vertices', np.arange(len(ends), dtype=np.int32))
+    mesh.update()
+    
+    obj = bpy.data.objects.new('bond', mesh)
+    bpy.context.scene.collection.objects.link(obj)
     
     # add new bonds material if it does not yet exist
     matbond = create_material('bond', '555555')
+    modifier = obj.modifiers.new('bond-tubes', 'NODES')
+    modifier.node_group = bond_node_group(matbond)
+    return obj
+
+def bond_ends(positions, bonds):
+    """
+    Returns the two ends of every bond one after another (2*bonds, 3)
+    """
+    start = positions[bonds['pairs'][:,0]]
+    end = 2*bonds['midpoints'] - start
+    return np.stack([start, end], axis=1).reshape(-1, 3)
+
+def point_object(name, positions):
+    """
+    Create an object with a mesh of only vertices at positions
+    """
+    mesh = bpy.data.meshes.new(name)
+    mesh.vertices.add(len(positions))
+    mesh.vertices.foreach_set('co', np.asarray(positions, dtype=np.float32).ravel())
+    mesh.update()
+    obj = bpy.data.objects.new(name, mesh)
+    bpy.context.scene.collection.objects.link(obj)
+    return obj
+
+def sphere_mesh(element, segments=32, rings=16):
+    """
+    Create the smooth sphere mesh shared by all atoms of an element
+    """
+    mesh = bpy.data.meshes.new('atom-mesh-%s' % element)
+    bm = bmesh.new()
+    bmesh.ops.create_uvsphere(bm, u_segments=segments, v_segments=rings,
+                              radius=atom_radii[element])
+    bm.to_mesh(mesh)
+    bm.free()
+    mesh.polygons.foreach_set('use_smooth', [True]*len(mesh.polygons))
+    
+    # set a material
+    mesh.materials.append(create_material(element, atom_colors[element]))
+    return mesh
+
+def bond_node_group(material, radius=0.2, resolution=16):
+    """
+    Build the Geometry Nodes turning the edges of a mesh into smooth tubes:
+    Mesh to Curve, Curve to Mesh with a circle profile, Set Material and
+    Set Shade Smooth
+    """
+    group = bpy.data.node_groups.new('bond-nodes', 'GeometryNodeTree')
+    if hasattr(group, 'interface'):
+        # Blender 4 moved the sockets of a group to its interface
+        group.interface.new_socket('Geometry', in_out='INPUT',
+                                   socket_type='NodeSocketGeometry')
+        group.interface.new_socket('Geometry', in_out='OUTPUT',
+                                   socket_type='NodeSocketGeometry')
+    else:
+        group.inputs.new('NodeSocketGeometry', 'Geometry')
+        group.outputs.new('NodeSocketGeometry', 'Geometry')
+    
+    nodes = group.nodes
+    group_input = nodes.new('NodeGroupInput')
+    to_curve = nodes.new('GeometryNodeMeshToCurve')
+    circle = nodes.new('GeometryNodeCurvePrimitiveCircle')
+    circle.inputs['Radius'].default_value = radius
+    circle.inputs['Resolution'].default_value = resolution
+    to_mesh = nodes.new('GeometryNodeCurveToMesh')
+    set_material = nodes.new('GeometryNodeSetMaterial')
+    set_material.inputs['Material'].default_value = material
+    smooth = nodes.new('GeometryNodeSetShadeSmooth')
+    group_output = nodes.new('NodeGroupOutput')
     
-    for i,at1 in enumerate(mol):
-        r1 = np.array(at1[1])
-        for j,at2 in enumerate(mol[i+1:]):
-            r2 = np.array(at2[1])
-            dist = np.linalg.norm(r2 - r1)
-            
-            # only create a bond if the distance is less than 1.5 A
-            if dist < 2.3:
-                axis = np.cross(z,r2-r1)
-                axis /= np.linalg.norm(axis)
-                angle = np.arccos(np.dot(r2-r1,z)/dist)
-                
-                bpy.ops.surface.primitive_nurbs_surface_cylinder_add(
-                    enter_editmode=False, 
-                    align='WORLD',
-                    location=tuple((r1 + r2) / 2)
-                )
-                
-                obj = bpy.context.view_layer.objects.active
-                obj.scale = (0.2, 0.2, dist/2)
-                obj.rotation_mode = 'AXIS_ANGLE'
-                obj.rotation_axis_angle = (angle, axis[0], axis[1], axis[2])
-                
-                obj.name = "bond-%s-%03i-%s-%03i" % (at1[0],i,at2[0],j)
-                bpy.ops.object.shade_smooth()
-                obj.data.materials.append(matbond)
+    links = group.links
+    links.new(group_input.outputs[0], to_curve.inputs['Mesh'])
+    links.new(to_curve.outputs['Curve'], to_mesh.inputs['Curve'])
+    links.new(circle.outputs['Curve'], to_mesh.inputs['Profile Curve'])
+    links.new(to_mesh.outputs['Mesh'], set_material.inputs['Geometry'])
+    links.new(set_material.outputs['Geometry'], smooth.inputs['Geometry'])
+    links.new(smooth.outputs['Geometry'], group_output.inputs[0])
+    return group
 
 def set_environment(settings):
     """
@@ -120,7 +352,7 @@ def set_environment(settings):
     camera and light, define film and set background
     """
     bpy.context.scene.render.engine = 'CYCLES'
-    bpy.context.scene.cycles.device = 'GPU'
+    bpy.context.scene.cycles.device = 'CPU'
     bpy.context.scene.render.resolution_x = settings['resolution']
     bpy.context.scene.render.resolution_y = settings['resolution']
     #bpy.context.scene.render.tile_x = settings['resolution']
@@ -195,11 +427,91 @@ def create_material(name, color, alpha=1.0):
 
     return mat
 
-def render_scene(outputfile, samples=512):
+def apply_profile(name, threads=None):
     """
-    Render the scene
+    Set the Cycles settings of a render profile
+    
+    name : key of render_profiles
+    threads : number of render threads, default all cores this process may
+              use, which follows the cores SLURM gives the job
+    """
+    profile = render_profiles[name]
+    scene = bpy.context.scene
+    cycles = scene.cycles
+    cycles.device = 'CPU'
+    
+    if threads is None:
+        threads = available_cpus()
+    scene.render.threads_mode = 'FIXED'
+    scene.render.threads = threads
+    
+    cycles.samples = profile['samples']
+    cycles.use_adaptive_sampling = profile['adaptive_threshold'] > 0
+    cycles.adaptive_threshold = profile['adaptive_threshold']
+    cycles.adaptive_min_samples = profile['adaptive_min_samples']
+    
+    cycles.use_denoising = profile['denoise']
+    if profile['denoise']:
+        cycles.denoiser = 'OPENIMAGEDENOISE'
+    
+    # total, diffuse, glossy, transmission and transparent bounces
+    cycles.max_bounces, cycles.diffuse_bounces, cycles.glossy_bounces, \
+        cycles.transmission_bounces, cycles.transparent_max_bounces = \
+        profile['bounces']
+    
+    cycles.use_auto_tile = True
+    cycles.tile_size = profile['tile_size']
+
+def benchmark(root, frame, profiles=('preview', 'production'),
+              reference='reference'):
     """
-    bpy.context.scene.cycles.samples = samples
+    Render one frame with every profile and report the seconds per frame and
+    the root mean square difference to a render with the reference profile
+    
+    Images are written to root/benchmark/<profile>.png
+    
+    root : folder with positions/<n>/CONTCAR
+    frame : step used as reference frame
+    profiles : profiles to compare
+    reference : profile of the reference image
+    """
+    mol = read_contcar(os.path.join(root, 'positions/%i/CONTCAR' % frame))
+    create_atoms(*mol)
+    create_bonds(*mol)
+    
+    folder = os.path.join(root, 'benchmark')
+    results = {}
+    for name in (reference,) + tuple(profiles):
+        apply_profile(name)
+        outputfile = os.path.join(folder, '%s.png' % name)
+        start = time.time()
+        render_scene(outputfile)
+        results[name] = [time.time() - start, read_pixels(outputfile)]
+    
+    print('%-12s %10s %10s' % ('profile', 'seconds', 'RMSE'))
+    for name in profiles:
+        seconds, pixels = results[name]
+        rmse = np.sqrt(np.mean((pixels - results[reference][1])**2))
+        print('%-12s %10.1f %10.5f' % (name, seconds, rmse))
+    prune_scene()
+    return results
+
+def read_pixels(filename):
+    """
+    Read an image as an array of RGBA floats
+    """
+    image = bpy.data.images.load(filename)
+    pixels = np.empty(len(image.pixels), dtype=np.float32)
+    image.pixels.foreach_get(pixels)
+    bpy.data.images.remove(image)
+    return pixels
+
+def render_scene(outputfile, samples=None):
+    """
+    Render the scene, with the samples of the render profile by default
+    """
+    if samples is not None:
+        bpy.context.scene.cycles.samples = samples
     
     print('Start render')
     start = time.time()
@@ -208,93 +520,24 @@ def render_scene(outputfile, samples=512):
     end = time.time()
     print('Finished rendering frame in %.1f seconds' % (end - start))
 
-def read_contcar(filename):
-    f = open(filename)
-    
-    # skip first line, name of system
-    f.readline()
-    
-    # extract scaling factor
-    scaling_factor = float(f.readline())
-    
-    # find the unitcell matrix
-    matrix = np.zeros((3,3))
-    for i in range(0,3):
-        row = f.readline().split()
-        for j in range(0,3):
-            matrix[i,j] = float(row[j])
-    matrix = scaling_factor * matrix
-    
-    # find the atoms and thei occurances
-    atoms = f.readline().split()
-    atoms_occurance = f.readline().split()
-    
-    # skip selective dynamics and direct coordinates line
-    f.readline()
-    f.readline()
-    
-    mol = []
-    for k in range(0,len(atoms)):
-        for l in range(0,int(atoms_occurance[k])):
-            # get fractional coordinates
-            c1c2c3 = f.readline().split()
-            c1 = float(c1c2c3[0])
-            c2 = float(c1c2c3[1])
-            c3 = float(c1c2c3[2])
-            c1c2c3 = [c1,c2,c3]
-            
-            xyz = matrix.transpose() @ c1c2c3
-            s_xyz = shift_struc(xyz)
-            
-            if s_xyz[2] > -6:
-                append_mol(mol,atoms[k],s_xyz) 
-            
-            sz = 2
-            if atoms[k] == "Rh":
-                for x in np.arange(-sz,sz+1):
-                    for y in np.arange(-sz,sz+1):
-                        if x == 0 and y == 0:
-                            print(' ')
-                        else:
-                            dup_c1c2c3 = c1c2c3.copy()
-                            dup_c1c2c3[0] = dup_c1c2c3[0] + x
-                            dup_c1c2c3[1] = dup_c1c2c3[1] + y
-                            xyz = np.matmul(matrix.transpose(),dup_c1c2c3)
-                            s_xyz = shift_struc(xyz)
-                
-                            if s_xyz[2] > -6:
-                                append_mol(mol,atoms[k],s_xyz) 
-                            
-    f.close()
-    
-    return mol
-
-def append_mol(mol,atom,xyz):
-    
-    mol.append(
-                [atom,
-                (
-                    xyz[0],
-                    xyz[1],
-                    xyz[2]
-                )]
-            )
-
-def shift_struc(xyz):
-    """
-    Places the structure on a predefined location
-    uses the zero position of the carbon adsorbed
-    """
-    x_set = 1.3519881656286596
-    y_set = 0.7805707313668949
-    z_set = 29.652349912212305
-    
-    xyz[0] = xyz[0]-x_set
-    xyz[1] = xyz[1]-y_set
-    xyz[2] = xyz[2]-z_set
-    
-    return xyz
-
+def render_animation(folder, frames, samples=None):
+    """
+    Render frames in one session to folder/<frame>.png, keeping the scene
+    data between frames
+    """
+    scene = bpy.context.scene
+    if samples is not None:
+        scene.cycles.samples = samples
+    scene.render.use_persistent_data = True
+    
+    print('Start render')
+    start = time.time()
+    for frame in frames:
+        scene.frame_set(frame)
+        render_scene(os.path.join(folder, '%i.png' % frame))
+    end = time.time()
+    print('Finished rendering %i frames in %.1f seconds' % (len(frames),
+                                                             end - start))
 
 def hex2rgbtuple(hexcode):
     """
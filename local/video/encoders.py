@@ -0,0 +1,195 @@
+import os
+import time
+import shutil
+import subprocess
+import numpy as np
+
+# Backends writing the video, auto takes ffmpeg when it is installed
+ENCODER_BACKENDS = ['auto', 'ffmpeg', 'opencv']
+
+# Pixel formats of libx264 which need an even width and height
+EVEN_PIX_FMTS = ['yuv420p', 'yuvj420p', 'yuv422p', 'nv12']
+
+class FFmpegEncoder:
+    """
+    Writes BGR frames through a pipe to an ffmpeg process encoding with
+    libx264
+
+    path : video file
+    size : width and height of the frames written
+    fps : frames per second
+    threads : threads of libx264, 0 lets ffmpeg choose
+    preset : libx264 preset, from ultrafast to veryslow
+    crf : constant rate factor, lower is better quality, 18 looks lossless
+    pix_fmt : pixel format of the video, yuv420p plays everywhere
+    resolution : width and height the frames are scaled to, default the
+                 frame size with an odd row or column cropped for the pixel
+                 formats which need an even size
+    ffmpeg : ffmpeg executable
+    """
+    def __init__(self, path, size, fps=30, threads=0, preset='medium', crf=18,
+                 pix_fmt='yuv420p', resolution=None, ffmpeg='ffmpeg'):
+        self.size = tuple(size)
+        command = [ffmpeg, '-y', '-loglevel', 'error',
+                   '-f', 'rawvideo', '-pix_fmt', 'bgr24',
+                   '-s', '%ix%i' % self.size, '-r', '%g' % fps, '-i', '-',
+                   '-an', '-c:v', 'libx264', '-preset', preset,
+                   '-crf', '%g' % crf, '-pix_fmt', pix_fmt,
+                   '-threads', '%i' % threads]
+        # Cropping the last row or column keeps the other pixels as they are,
+        # scaling by one pixel would blur the whole frame
+        if resolution is None:
+            crop = output_resolution(size, pix_fmt)
+            if crop != self.size:
+                command += ['-vf', 'crop=%i:%i:0:0' % crop]
+        else:
+            resolution = output_resolution(size, pix_fmt, resolution)
+            if resolution != self.size:
+                command += ['-vf', 'scale=%i:%i' % resolution]
+        command.append(path)
+        self.process = subprocess.Popen(command, stdin=subprocess.PIPE)
+
+    def write(self, frame):
+        """
+        Writes a BGR frame (height, width, 3)
+        """
+        if frame.shape != (self.size[1], self.size[0], 3):
+            raise Exception('Frame of shape %s, expected %ix%i' %
+                            (frame.shape, *self.size))
+        self.process.stdin.write(memoryview(np.ascontiguousarray(frame)))
+
+    def close(self):
+        self.process.stdin.close()
+        if self.process.wait() != 0:
+            raise Exception('ffmpeg failed with exit code %i' %
+                            self.process.returncode)
+
+class OpenCVEncoder:
+    """
+    Writes BGR frames with cv2.VideoWriter, which depends on how OpenCV was
+    built. The first fourcc which opens is used. OpenCV chooses the codec
+    settings and threads itself, so there is no preset, crf, pixel format
+    or number of threads.
+
+    path : video file
+    size : width and height of the frames written
+    fps : frames per second
+    resolution : width and height of the video, default the frame size
+    fourccs : codecs tried in turn
+    """
+    def __init__(self, path, size, fps=30, resolution=None,
+                 fourccs=('avc1', 'mp4v')):
+        import cv2
+        self.cv2 = cv2
+        self.size = tuple(size)
+        self.resolution = tuple(resolution or size)
+        for fourcc in fourccs:
+            self.video = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*fourcc),
+                                         fps, self.resolution)
+            if self.video.isOpened():
+                self.fourcc = fourcc
+                return
+        raise Exception('OpenCV cannot write %s with any of %s' %
+                        (path, ', '.join(fourccs)))
+
+    def write(self, frame):
+        """
+        Writes a BGR frame (height, width, 3)
+        """
+        if frame.shape != (self.size[1], self.size[0], 3):
+            raise Exception('Frame of shape %s, expected %ix%i' %
+                            (frame.shape, *self.size))
+        if self.resolution != self.size:
+            frame = self.cv2.resize(frame, self.resolution,
+                                    interpolation=self.cv2.INTER_AREA)
+        self.video.write(np.ascontiguousarray(frame))
+
+    def close(self):
+        self.video.release()
+
+def output_resolution(size, pix_fmt='yuv420p', resolution=None):
+    """
+    Returns the width and height of the video, rounded down to even numbers
+    for the pixel formats which need them
+    """
+    width, height = resolution or size
+    if pix_fmt in EVEN_PIX_FMTS:
+        width, height = width // 2 * 2, height // 2 * 2
+    return int(width), int(height)
+
+def find_backend(backend='auto', ffmpeg='ffmpeg'):
+    """
+    Returns the backend to use, auto takes ffmpeg when the executable is
+    found and OpenCV otherwise
+    """
+    if backend not in ENCODER_BACKENDS:
+        raise Exception('Unknown encoder backend: %s' % backend)
+    if backend != 'auto':
+        return backend
+    return 'ffmpeg' if shutil.which(ffmpeg) else 'opencv'
+
+def open_encoder(path, size, backend='auto', fps=30, threads=0,
+                 preset='medium', crf=18, pix_fmt='yuv420p', resolution=None,
+                 ffmpeg='ffmpeg'):
+    """
+    Returns an encoder with methods write(frame) and close()
+
+    backend : one of ENCODER_BACKENDS
+    other arguments : see FFmpegEncoder and OpenCVEncoder, OpenCV ignores
+                      threads, preset, crf and pix_fmt
+    """
+    backend = find_backend(backend, ffmpeg)
+    if backend == 'ffmpeg':
+        return FFmpegEncoder(path, size, fps, threads, preset, crf, pix_fmt,
+                             resolution, ffmpeg)
+    return OpenCVEncoder(path, size, fps, resolution)
+
+def synthetic_frames(size, count=8, seed=0):
+    """
+    Returns count BGR frames of a moving gradient with noise, which encode
+    about as hard as the stitched frames
+    """
+    width, height = size
+    rng = np.random.default_rng(seed)
+    x = np.linspace(0, 255, width)
+    y = np.linspace(0, 255, height)[:,None]
+    frames = []
+    for n in range(count):
+        base = (x + y + 8*n) % 256
+        frame = np.stack([base, np.roll(base, 64*n, axis=1), 255 - base],
+                         axis=2)
+        frame += rng.normal(0, 4, frame.shape)
+        frames.append(np.clip(frame, 0, 255).astype(np.uint8))
+    return frames
+
+def benchmark(folder, frames=60, size=(4096, 2731), backends=('ffmpeg', 'opencv'),
+              **options):
+    """
+    Encodes the same synthetic frames with every backend and prints the
+    frames per second
+
+    folder : folder for the test videos, which are removed afterwards
+    frames : number of frames encoded
+    size : width and height of the frames
+    options : settings of open_encoder
+    """
+    images = synthetic_frames(size)
+    results = {}
+    for backend in backends:
+        path = os.path.join(folder, 'benchmark_%s.mp4' % backend)
+        try:
+            encoder = open_encoder(path, size, backend, **options)
+        except Exception as error:
+            print('%-8s not available: %s' % (backend, error))
+            continue
+        start = time.perf_counter()
+        for n in range(frames):
+            encoder.write(images[n % len(images)])
+        encoder.close()
+        seconds = time.perf_counter() - start
+        results[backend] = frames / seconds
+        codec = getattr(encoder, 'fourcc', 'libx264')
+        print('%-8s %-8s %6.1f fps  %8.1f MB' % (backend, codec,
+              results[backend], os.path.getsize(path) / 1e6))
+        os.remove(path)
+    return results
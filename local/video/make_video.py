@@ -1,65 +1,260 @@
-import cv2
 import os
+import sys
+import argparse
+import multiprocessing
+from collections import deque
 from PIL import Image, ImageOps
 import numpy as np
+from encoders import ENCODER_BACKENDS, open_encoder, benchmark
+
+# The cores are counted by structure.py of the HPC scripts
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             '..', '..', 'HPC'))
+from structure import available_cpus
+
+# Place of the Blender image on the plot images made on the HPC and the size
+# of the video frames
+SYST_OFFSET = (4200, 1850)
+SYST_SIZE = (2000, 2000)
+FRAME_SIZE = (4096, 2731)
+BORDER = 2
 
 def main():
 
     # set path of this folder
     folder = os.path.join(os.path.dirname(__file__))
     
-    # clean up images and stich together
-    for img in np.arange(1,301):
-        plot_image = Image.open(os.path.join(folder, 'plot_images', '%i.png' %img)).convert("RGBA")
-        
-        #cleaning up system image
-        syst_image = Image.open(os.path.join(folder, 'syst_images', '%i.png' %img)).convert("RGBA")
-        line_width = 2
-        border = (line_width,line_width,line_width,line_width)
-        border_img = ImageOps.expand(syst_image, border=border, fill='#000000')
-        scaled_img = border_img.resize((2000,2000))
-        
-        image = stich_images(plot_image, scaled_img)
-        resize_image = image.resize((4096,2731))
-        resize_image.save(os.path.join(folder, 'images', '%i.png' %img))#, quality=90)
-    
-    
-    # make video
-    video_name = os.path.join(os.path.dirname(__file__),'ideo_name.mp4')
-    
-    images = []
-    for file in np.arange(1,301):
-        images.append(f'{file}.png')
-        
-    frame = cv2.imread(os.path.join(folder,'images', images[0]))
-    
-    height, width, layers = frame.shape
-    fourcc = cv2.VideoWriter_fourcc(*'avc1')
-    
-    video = cv2.VideoWriter(video_name, fourcc, 30, (width,height))
-
-    # adding images to video
-    for image in images:
-        video.write(cv2.imread(os.path.join(folder, 'images', image)))
+    parser = argparse.ArgumentParser(
+        description='Stitches the plot and Blender images together and '
+                    'encodes them as a video played forward and backward')
+    parser.add_argument('--output', default=os.path.join(folder, 'ideo_name.mp4'),
+                        help='video file')
+    parser.add_argument('--save-images', action='store_true',
+                        help='also write the stitched frames to images/')
+    parser.add_argument('--buffer', default='memmap', choices=['memmap', 'memory'],
+                        help='keep the frames for the backward pass in a raw '
+                             'file next to the video or in memory')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='processes stitching frames, default all cores')
+    parser.add_argument('--encoder', default='auto', choices=ENCODER_BACKENDS,
+                        help='ffmpeg pipes raw frames to libx264, opencv uses '
+                             'cv2.VideoWriter, auto takes ffmpeg if installed')
+    parser.add_argument('--ffmpeg', default=os.environ.get('FFMPEG', 'ffmpeg'),
+                        help='ffmpeg executable')
+    parser.add_argument('--threads', type=int, default=0,
+                        help='libx264 threads, 0 lets ffmpeg choose')
+    parser.add_argument('--preset', default='medium',
+                        help='libx264 preset, ultrafast to veryslow')
+    parser.add_argument('--crf', type=float, default=18,
+                        help='libx264 constant rate factor, lower is better')
+    parser.add_argument('--pix-fmt', default='yuv420p',
+                        help='pixel format of the video')
+    parser.add_argument('--resolution', default=None,
+                        help='size of the video as WIDTHxHEIGHT, default the '
+                             'frame size rounded to even numbers')
+    parser.add_argument('--fps', type=float, default=30,
+                        help='frames per second')
+    parser.add_argument('--benchmark', type=int, default=0, metavar='FRAMES',
+                        help='only encode this many synthetic frames with every '
+                             'backend and print the frames per second')
+    args = parser.parse_args()
+    
+    workers = args.workers
+    if workers is None:
+        workers = available_cpus()
+    
+    resolution = None
+    if args.resolution:
+        resolution = tuple(int(n) for n in args.resolution.lower().split('x'))
+    options = dict(fps=args.fps, threads=args.threads, preset=args.preset,
+                   crf=args.crf, pix_fmt=args.pix_fmt, resolution=resolution,
+                   ffmpeg=args.ffmpeg)
     
-    # change order images and add again to video
-    images.reverse()
+    if args.benchmark:
+        benchmark(os.path.dirname(os.path.abspath(args.output)),
+                  args.benchmark, FRAME_SIZE, **options)
+        return
     
-    for image in images:
-        video.write(cv2.imread(os.path.join(folder, 'images', image)))
+    # number of steps, taken from the plot images made on the HPC
+    steps = count_frames(os.path.join(folder, 'plot_images'))
+    
+    # the place of the Blender image on the frames is the same for all steps
+    plot_size = Image.open(os.path.join(folder, 'plot_images', '1.png')).size
+    box = frame_geometry(plot_size)
+    width, height = FRAME_SIZE
+    
+    video = open_encoder(args.output, FRAME_SIZE, args.encoder, **options)
+    buffer = frame_buffer(args.buffer, args.output + '.raw',
+                          (steps, height, width, 3))
+    
+    # stich images together and add them to the video in order as they
+    # are made
+    images = os.path.join(folder, 'images') if args.save_images else None
+    frames = ordered_frames(folder, np.arange(1,steps+1), box,
+                            workers=workers, images=images)
+    for n, frame in enumerate(frames):
+        video.write(frame)
+        buffer[n] = frame
+    
+    # add the frames again in reversed order
+    for n in reversed(range(steps)):
+        video.write(buffer[n])
     
     # finish video
-    cv2.destroyAllWindows()
-    video.release()
+    video.close()
+    if args.buffer == 'memmap':
+        del buffer
+        os.remove(args.output + '.raw')
+
+def frame_geometry(plot_size, size=FRAME_SIZE, offset=SYST_OFFSET,
+                   syst_size=SYST_SIZE):
+    """
+    Returns the box (left, top, right, bottom) of the Blender image on the
+    video frame. The Blender image is resized once, straight to its size on
+    the frame, instead of to syst_size on the plot before the whole plot is
+    resized to the frame size.
+    
+    plot_size : width and height of the plot images
+    size : width and height of the video frames
+    offset : place of the Blender image on the plot images
+    syst_size : size of the Blender image on the plot images
+    """
+    scale = np.array(size) / np.array(plot_size)
+    left, top = np.rint(np.array(offset) * scale).astype(int)
+    right, bottom = np.rint((np.array(offset) + syst_size) * scale).astype(int)
+    if right > size[0] or bottom > size[1]:
+        raise Exception('Blender image does not fit on plot of size %s' % (plot_size,))
+    return int(left), int(top), int(right), int(bottom)
+
+def frame_buffers(size, box):
+    """
+    Returns the arrays reused by composite_frame for every frame
+    """
+    left, top, right, bottom = box
+    return {
+        'frame' : np.empty((size[1], size[0], 3), dtype=np.uint8),
+        'blend' : np.empty((bottom-top, right-left, 3), dtype=np.uint16),
+        'under' : np.empty((bottom-top, right-left, 3), dtype=np.uint16),
+        'alpha' : np.empty((bottom-top, right-left, 1), dtype=np.uint16),
+        }
+
+def composite_frame(folder, img, box, size=FRAME_SIZE, buffers=None):
+    """
+    Stitches the plot image and the Blender image of a step together
+    
+    Returns the video frame as BGR array (height, width, 3), which is reused
+    for the next frame when buffers are given.
+    
+    folder : folder with plot_images and syst_images
+    img : step
+    box : place of the Blender image, returned by frame_geometry
+    size : width and height of the video frame
+    buffers : arrays returned by frame_buffers
+    """
+    if buffers is None:
+        buffers = frame_buffers(size, box)
+    frame = buffers['frame']
+    left, top, right, bottom = box
+    
+    plot_image = Image.open(os.path.join(folder, 'plot_images', '%i.png' %img)).convert("RGB")
+    np.copyto(frame, np.asarray(plot_image.resize(size))[:,:,::-1])
+    
+    #cleaning up system image
+    syst_image = Image.open(os.path.join(folder, 'syst_images', '%i.png' %img)).convert("RGBA")
+    border = (BORDER,BORDER,BORDER,BORDER)
+    border_img = ImageOps.expand(syst_image, border=border, fill='#000000')
+    syst = np.asarray(border_img.resize((right-left, bottom-top)))
+    
+    # alpha blend the Blender image over the plot, rounded like PIL
+    region = frame[top:bottom, left:right]
+    blend, under, alpha = buffers['blend'], buffers['under'], buffers['alpha']
+    np.copyto(alpha, syst[:,:,3:])
+    np.multiply(syst[:,:,2::-1], alpha, out=blend)
+    np.subtract(255, alpha, out=alpha)
+    np.multiply(region, alpha, out=under)
+    blend += under
+    blend += 127
+    blend //= 255
+    np.copyto(region, blend, casting='unsafe')
+    return frame
+
+# Settings of the process making frames, set by init_worker
+_worker = {}
+
+def init_worker(folder, box, size=FRAME_SIZE, images=None):
+    """
+    Prepares a process for making frames with make_frame
     
-def stich_images(plot_img,syst_img):
+    images : folder to save the stitched frames in, None saves nothing
+    """
+    _worker.update(folder=folder, box=box, size=size, images=images,
+                   buffers=frame_buffers(size, box))
+
+def make_frame(img):
+    """
+    Returns the video frame of a step, made with the settings of init_worker
     """
-    stiches two images together
+    frame = composite_frame(_worker['folder'], img, _worker['box'],
+                            _worker['size'], _worker['buffers'])
+    if _worker['images']:
+        Image.fromarray(frame[:,:,::-1]).save(
+            os.path.join(_worker['images'], '%i.png' %img))
+    return frame
+
+def ordered_frames(folder, steps, box, size=FRAME_SIZE, workers=1, images=None):
     """
-    plot_img.paste(syst_img, (4200,1850), mask=syst_img)
+    Yields the video frames of the steps in order, made by a pool of processes
+    
+    At most two frames per process are made ahead of the one yielded, so the
+    frames do not pile up in memory when encoding is slower than stitching.
     
-    return plot_img
+    folder, box, size, images : settings of init_worker
+    steps : steps to make frames of
+    workers : number of processes, 1 makes the frames in this process
+    """
+    if workers <= 1:
+        init_worker(folder, box, size, images)
+        for img in steps:
+            yield make_frame(img)
+        return
+    
+    # The steps are handed to the pool one at a time instead of through
+    # imap, whose task thread would wait for the consumer and keep the pool
+    # from shutting down when the consumer stops early
+    with multiprocessing.Pool(workers, init_worker,
+                              (folder, box, size, images)) as pool:
+        pending = deque()
+        for img in steps:
+            pending.append(pool.apply_async(make_frame, (img,)))
+            if len(pending) > 2*workers:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+
+def frame_buffer(kind, path, shape):
+    """
+    Returns an array holding all frames, either in memory or in a raw file
+    mapped into memory, which needs no more memory than the page cache
+    gives it
     
+    kind : 'memory' or 'memmap'
+    path : raw file of the memmap
+    shape : (frames, height, width, channels)
+    """
+    if kind == 'memory':
+        return np.empty(shape, dtype=np.uint8)
+    return np.memmap(path, dtype=np.uint8, mode='w+', shape=shape)
     
+def count_frames(folder):
+    """
+    Counts the images 1.png, 2.png, ... in a folder
+    """
+    steps = 0
+    while os.path.isfile(os.path.join(folder, '%i.png' % (steps+1))):
+        steps += 1
+    if steps == 0:
+        raise Exception('No images found in %s' % folder)
+    return steps
+
 if __name__ == '__main__':
     main()